@@ -0,0 +1,236 @@
+import threading
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from core.config import ConfigMgr
+from core.comfyui.basic_client import BasicClient
+
+DEFAULT_HEALTH_CHECK_SECONDS = 5
+# per request, not retried, a hung backend must not hold up the others
+DEFAULT_HEALTH_CHECK_TIMEOUT_SECONDS = 2
+# consecutive failures before a backend is taken out of rotation
+DEFAULT_UNHEALTHY_THRESHOLD = 2
+# prompts queued on one backend at once, more than 1 keeps its queue busy
+# while we download results of the last prompt
+DEFAULT_MAX_INFLIGHT_PER_BACKEND = 2
+
+
+class ComfyUIBackend:
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+        self.client = BasicClient(
+            client_id="agent_health_check", server_address=endpoint
+        )
+
+        self.healthy = True
+        self.fail_count = 0
+        self.last_err = None
+        self.last_check_at = 0.0
+
+        # live load
+        self.queue_remaining = 0
+        self.vram_free = 0
+        self.inflight = 0
+        self.dispatched = 0
+
+    def load(self) -> int:
+        # queue_remaining is refreshed by health check only, inflight covers
+        # the tasks we dispatched since then
+        return max(self.queue_remaining, self.inflight)
+
+    def metrics(self) -> dict:
+        return {
+            "endpoint": self.endpoint,
+            "healthy": self.healthy,
+            "fail_count": self.fail_count,
+            "last_err": self.last_err,
+            "queue_remaining": self.queue_remaining,
+            "vram_free": self.vram_free,
+            "inflight": self.inflight,
+            "dispatched": self.dispatched,
+        }
+
+
+class BackendPool:
+    """
+    comfyui backends from config, dispatch every task to the least loaded
+    healthy backend with a free in-flight slot
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    # publish only after init, workers race on first use
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        comfyui_conf = ConfigMgr().get_conf("comfyui")
+        endpoints = [comfyui_conf["endpoint"]] + (comfyui_conf.get("endpoints") or [])
+        self.backends: Dict[str, ComfyUIBackend] = {}
+        for endpoint in endpoints:
+            if endpoint not in self.backends:
+                self.backends[endpoint] = ComfyUIBackend(endpoint)
+        self.health_check_seconds = comfyui_conf.get(
+            "health_check_seconds", DEFAULT_HEALTH_CHECK_SECONDS
+        )
+        self.health_check_timeout = comfyui_conf.get(
+            "health_check_timeout_seconds", DEFAULT_HEALTH_CHECK_TIMEOUT_SECONDS
+        )
+        self.unhealthy_threshold = comfyui_conf.get(
+            "unhealthy_threshold", DEFAULT_UNHEALTHY_THRESHOLD
+        )
+        self.max_inflight = comfyui_conf.get(
+            "max_inflight_per_backend", DEFAULT_MAX_INFLIGHT_PER_BACKEND
+        )
+        self._mutex = threading.Lock()
+        # notified when a slot is released or a backend comes back
+        self._slot_cond = threading.Condition(self._mutex)
+        self.waiting = 0
+        # slots promised to tasks taken from the queue, not acquired yet
+        self.reserved = 0
+        threading.Thread(
+            target=self._health_check_loop, name="BackendPoolHealthCheck", daemon=True
+        ).start()
+        logging.info(f"[comfyui]backend pool init done, endpoints: {endpoints}")
+
+    def healthy_backends(self) -> List[ComfyUIBackend]:
+        with self._mutex:
+            return [b for b in self.backends.values() if b.healthy]
+
+    def reserve(self):
+        """
+        blocks while every healthy backend is full with prompts and
+        reservations, so a worker takes a task from the fair queue only when
+        it can be submitted, the caller unreserves once it acquired a slot or
+        needs none
+        """
+        with self._slot_cond:
+            # without healthy backends acquire fails the task at once
+            while (
+                any(b.healthy for b in self.backends.values())
+                and self._free_slots() <= 0
+            ):
+                self._slot_cond.wait(self.health_check_seconds)
+            self.reserved += 1
+
+    def unreserve(self):
+        with self._slot_cond:
+            self.reserved -= 1
+            self._slot_cond.notify_all()
+
+    def acquire(
+        self, accepts: Callable[[ComfyUIBackend], bool] = None
+    ) -> ComfyUIBackend:
+        """
+        blocks while every healthy backend has max_inflight prompts
+
+        accepts: only these backends are picked, e.g. those having the models
+        of the prompt
+        """
+        with self._slot_cond:
+            while True:
+                healthy = [b for b in self.backends.values() if b.healthy]
+                if len(healthy) == 0:
+                    raise Exception("no healthy comfyui backend")
+                if accepts and not any(accepts(b) for b in healthy):
+                    raise Exception("no healthy comfyui backend can run the prompt")
+                backend = self._pick(accepts)
+                if backend is not None:
+                    break
+                self.waiting += 1
+                try:
+                    self._slot_cond.wait(self.health_check_seconds)
+                finally:
+                    self.waiting -= 1
+            backend.inflight += 1
+            backend.dispatched += 1
+            return backend
+
+    def release(self, backend: ComfyUIBackend):
+        with self._slot_cond:
+            backend.inflight -= 1
+            # waiters of acquire and of reserve
+            self._slot_cond.notify_all()
+
+    def report_failure(self, backend: ComfyUIBackend, err: Exception):
+        with self._mutex:
+            self._mark_failed(backend, err)
+
+    def metrics(self) -> List[dict]:
+        with self._mutex:
+            return [b.metrics() for b in self.backends.values()]
+
+    def _free_slots(self) -> float:
+        if self.max_inflight <= 0:
+            return float("inf")
+        free = sum(
+            max(self.max_inflight - b.inflight, 0)
+            for b in self.backends.values()
+            if b.healthy
+        )
+        return free - self.reserved
+
+    def _pick(
+        self, accepts: Callable[[ComfyUIBackend], bool] = None
+    ) -> Optional[ComfyUIBackend]:
+        candidates = [
+            b
+            for b in self.backends.values()
+            if b.healthy
+            and (self.max_inflight <= 0 or b.inflight < self.max_inflight)
+            and (accepts is None or accepts(b))
+        ]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda b: (b.load(), -b.vram_free))
+
+    def _mark_failed(self, backend: ComfyUIBackend, err: Exception):
+        backend.fail_count += 1
+        backend.last_err = f"{err}"
+        if backend.healthy and backend.fail_count >= self.unhealthy_threshold:
+            backend.healthy = False
+            logging.warning(
+                f"[comfyui]backend {backend.endpoint} out of rotation, err: {err}"
+            )
+
+    def _check(self, backend: ComfyUIBackend):
+        try:
+            queue_remaining = backend.client.get_prompt_api(
+                timeout=self.health_check_timeout, tries=1
+            ).exec_info.queue_remaining
+            system_stats = backend.client.get_system_stats_api(
+                timeout=self.health_check_timeout, tries=1
+            )
+        except Exception as err:
+            with self._mutex:
+                self._mark_failed(backend, err)
+            return
+        with self._slot_cond:
+            if not backend.healthy:
+                logging.info(f"[comfyui]backend {backend.endpoint} back to rotation")
+                self._slot_cond.notify_all()
+            backend.healthy = True
+            backend.fail_count = 0
+            backend.last_err = None
+            backend.queue_remaining = queue_remaining
+            backend.vram_free = sum(d.vram_free for d in system_stats.devices)
+            backend.last_check_at = time.time()
+
+    def _health_check_loop(self):
+        # in parallel, a hung backend only delays its own check
+        with ThreadPoolExecutor(
+            max_workers=len(self.backends),
+            thread_name_prefix="BackendPoolHealthCheck",
+        ) as executor:
+            while True:
+                list(executor.map(self._check, list(self.backends.values())))
+                time.sleep(self.health_check_seconds)
@@ -5,6 +5,7 @@ from typing import List, Optional
 from pydantic import BaseModel
 
 from core.config import ConfigMgr
+from core.comfyui.transport import HttpTransport, ComfyUIRequestError
 
 
 class UploadImageResponse(BaseModel):
@@ -48,22 +49,31 @@ class PostPromptResponse(BaseModel):
 
 
 class BasicClient:
-    def __init__(self, client_id: str) -> None:
+    def __init__(self, client_id: str, server_address: str = None) -> None:
         self.client_id = client_id
-        self.session = requests.Session()
+        self._server_address = server_address
+        self.transport = HttpTransport()
+        self.session = self.transport.session
+
+    @property
+    def server_address(self) -> str:
+        if self._server_address:
+            return self._server_address
+        return ConfigMgr().get_conf("comfyui")["endpoint"]
+
+    def _request(
+        self, method: str, path: str, api_name: str, **kwargs
+    ) -> requests.Response:
+        return self.transport.request(
+            method, self.server_address, path, api_name, **kwargs
+        )
 
     def get_embeddings_api(self) -> List:
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/embeddings")
-        if resp.status_code != 200:
-            raise Exception(f"get_embeddings_api failed: {resp.json()}")
+        resp = self._request("GET", "/embeddings", "get_embeddings_api")
         return resp.json()
 
     def get_extensions_api(self) -> List:
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/extensions")
-        if resp.status_code != 200:
-            raise Exception(f"get_extensions_api failed: {resp.json()}")
+        resp = self._request("GET", "/extensions", "get_extensions_api")
         return resp.json()
 
     def upload_image_api(
@@ -80,17 +90,14 @@ class BasicClient:
         type: input or temp or output
         """
         files = {"image": (filename, image)}
+        data = {}
         if overwrite:
-            files["overwrite"] = overwrite
+            data["overwrite"] = "true"
         if type:
-            files["type"] = type
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.post(
-            f"http://{server_address}/upload/image",
-            files=files,
+            data["type"] = type
+        resp = self._request(
+            "POST", "/upload/image", "upload_image_api", files=files, data=data
         )
-        if resp.status_code != 200:
-            raise Exception(f"upload_image_api failed: {resp.json()}")
         return UploadImageResponse.model_validate(resp.json())
 
     def upload_mask_api(self):
@@ -109,65 +116,109 @@ class BasicClient:
             "type": type,
             "subfolder": subfolder,
         }
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/view", params=params)
-        if resp.status_code != 200:
-            raise Exception(f"view_image_api failed: {resp.json()}")
+        resp = self._request("GET", "/view", "view_image_api", params=params)
         return resp.content
 
+    def view_image_to_file_api(
+        self,
+        filepath: str,
+        filename: str,
+        type: str = "output",
+        subfolder: str = "",
+        chunk_size: int = 64 * 1024,
+    ) -> str:
+        """
+        stream the image straight into filepath without holding it in memory
+        """
+        params = {
+            "filename": filename,
+            "type": type,
+            "subfolder": subfolder,
+        }
+        tmp_filepath = f"{filepath}.part"
+        with self._request(
+            "GET", "/view", "view_image_to_file_api", params=params, stream=True
+        ) as resp:
+            try:
+                with open(tmp_filepath, "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                os.replace(tmp_filepath, filepath)
+            except Exception as err:
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+                raise err
+        return filepath
+
+    def check_image_api(
+        self, filename: str, type: str = "input", subfolder: str = ""
+    ) -> bool:
+        """
+        HEAD /view, True if comfyui has the file
+        """
+        params = {
+            "filename": filename,
+            "type": type,
+            "subfolder": subfolder,
+        }
+        try:
+            self._request(
+                "HEAD", "/view", "check_image_api", params=params, idempotent=True
+            )
+        except ComfyUIRequestError as err:
+            if err.status_code in (400, 404):
+                return False
+            raise err
+        return True
+
     def view_metadata_api(self):
         raise NotImplementedError()
 
-    def get_system_stats_api(self) -> SystemStatsResponse:
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/system_stats")
-        if resp.status_code != 200:
-            raise Exception(f"get_system_stats_api failed: {resp.json()}")
+    def get_system_stats_api(
+        self, timeout: float = None, tries: int = None
+    ) -> SystemStatsResponse:
+        resp = self._request(
+            "GET",
+            "/system_stats",
+            "get_system_stats_api",
+            timeout=timeout,
+            tries=tries,
+        )
         return SystemStatsResponse.model_validate(resp.json())
 
-    def get_prompt_api(self) -> GetPromptResponse:
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/prompt")
-        if resp.status_code != 200:
-            raise Exception(f"get_prompt_api failed: {resp.json()}")
+    def get_prompt_api(
+        self, timeout: float = None, tries: int = None
+    ) -> GetPromptResponse:
+        resp = self._request(
+            "GET", "/prompt", "get_prompt_api", timeout=timeout, tries=tries
+        )
         return GetPromptResponse.model_validate(resp.json())
 
     def get_object_info_api(self):
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/object_info")
-        if resp.status_code != 200:
-            raise Exception(f"get_object_info_api failed: {resp.json()}")
+        resp = self._request("GET", "/object_info", "get_object_info_api")
         return resp.json()
 
     def get_object_info_node_api(self, node_class: str):
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/object_info/{node_class}")
-        if resp.status_code != 200:
-            raise Exception(f"get_object_info_node_api failed: {resp.json()}")
+        resp = self._request(
+            "GET", f"/object_info/{node_class}", "get_object_info_node_api"
+        )
         return resp.json()
 
     def get_history_api(self, max_items: int = None):
         params = {}
         if max_items:
             params["max_items"] = max_items
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/history", params=params)
-        if resp.status_code != 200:
-            raise Exception(f"get_history_api failed: {resp.json()}")
+        resp = self._request("GET", "/history", "get_history_api", params=params)
         return resp.json()
 
     def get_history_by_prompt_id_api(self, prompt_id: str):
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/history/{prompt_id}")
-        if resp.status_code != 200:
-            raise Exception(f"get_history_api failed: {resp.json()}")
+        resp = self._request(
+            "GET", f"/history/{prompt_id}", "get_history_by_prompt_id_api"
+        )
         return resp.json()
 
     def get_queue_api(self):
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.get(f"http://{server_address}/queue")
-        if resp.status_code != 200:
-            raise Exception(f"get_queue_api failed: {resp.json()}")
+        resp = self._request("GET", "/queue", "get_queue_api")
         return resp.json()
 
     def post_prompt_api(
@@ -179,19 +230,27 @@ class BasicClient:
     ) -> PostPromptResponse:
         p = {"prompt": prompt_json, "client_id": self.client_id}
         data = json.dumps(p).encode("utf-8")
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        resp = self.session.post(f"http://{server_address}/prompt", data=data)
-        if resp.status_code != 200:
-            raise Exception(
-                f"post_prompt_api failed, status_code: {resp.status_code}, {resp.json()}"
-            )
+        resp = self._request("POST", "/prompt", "post_prompt_api", data=data)
         return PostPromptResponse.model_validate(resp.json())
 
-    def post_queue_api(self):
-        raise NotImplementedError()
-
-    def post_interrupt_api(self):
-        raise NotImplementedError()
+    def post_queue_api(self, delete: List[str] = None, clear: bool = False):
+        """
+        delete pending prompts by prompt_id, or clear the whole pending queue
+        """
+        p = {}
+        if delete:
+            p["delete"] = delete
+        if clear:
+            p["clear"] = True
+        self._request("POST", "/queue", "post_queue_api", json=p, idempotent=True)
+
+    def post_interrupt_api(self, prompt_id: str = None):
+        """
+        interrupt the running prompt, only if it is prompt_id when given,
+        comfyui versions without targeted interrupt stop whichever runs
+        """
+        p = {"prompt_id": prompt_id} if prompt_id else {}
+        self._request("POST", "/interrupt", "post_interrupt_api", json=p)
 
     def post_free_api(self):
         raise NotImplementedError()
@@ -1,17 +1,52 @@
-import websocket  # NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
-import uuid
-import json
+import os
 import uuid
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 from enum import Enum
+from typing import Dict, List, Optional, Tuple
+from queue import Queue, Empty
 
 from core.comfyui.basic_client import BasicClient
+from core.comfyui.backend_pool import BackendPool, ComfyUIBackend
+from core.comfyui.object_info import ObjectInfoCatalog
+from core.comfyui.transport import ComfyUIRetryableError, CircuitOpenError
+from core.comfyui.ws_client import (
+    ComfyUIWSClient,
+    WS_MSG_RECONNECTED,
+    WS_MSG_PREVIEW,
+)
+from core.comfyui.preview import PreviewForwarder
+from core.comfyui.upload_cache import UploadCache
 from .model import *
 from core.const import *
 from core.models.common import WSEvent
 from core.server.event import EventDispatcher
 from core.config import ConfigMgr
 
+WS_CONNECT_TIMEOUT = 5
+# no ws message for this long, check /history in case messages were missed
+WS_HISTORY_POLL_SECONDS = 10
+# the task fails after this many /history polls in a row failed
+WS_HISTORY_POLL_MAX_FAILURES = 6
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+# synthetic message put to the prompt queue when the task is canceled
+WS_MSG_CANCELED = "agent_task_canceled"
+
+
+class TaskCanceledError(Exception):
+    pass
+
+
+class TaskPreemptedError(TaskCanceledError):
+    """
+    the prompt was stopped for a task of higher priority, its tasks are
+    run again later
+    """
+
+    pass
+
 
 class ComfyUIProgressName(Enum):
     SUBMIT_TASK = "任务提交绘图引擎"
@@ -32,88 +67,466 @@ class ComfyUIEventData(BaseModel):
     err_msg: Optional[str] = None
 
 
+class PromptState:
+    """
+    one prompt in flight on a backend, it may serve several coalesced tasks
+    """
+
+    def __init__(
+        self,
+        backend: ComfyUIBackend,
+        backend_client: BasicClient,
+        task_ids: List[int],
+        prompt_json,
+        result_image_node_ids: List[str],
+        output_dir: str,
+    ) -> None:
+        self.backend = backend
+        self.backend_client = backend_client
+        self.task_ids = task_ids
+        self.task_id = task_ids[0]
+        self.prompt_id = None
+        self.messages: Queue = None
+        self.prompt_json = prompt_json
+        self.nodes = list(prompt_json.keys())
+        self.nodes_done = []
+        self.cur_exec_node = None
+        self.result_image_node_ids = result_image_node_ids
+        self.output_dir = output_dir
+        self.preempted = False
+        # canceled or preempted, the waiter has been told
+        self.stopped = False
+        # posted to comfyui, execution_start and end of execution, for eta
+        self.queued_at = None
+        self.started_at = None
+        self.executed_at = None
+        # (node class_type, seconds) from executing transitions
+        self.node_seconds: List[Tuple[str, float]] = []
+        self.node_started_at = None
+        # result node_id -> downloads
+        self.image_futures: Dict[str, List[Future]] = {}
+
+
 class ComfyUIClient(BasicClient):
+    """
+    several prompts may be in flight at once, submit_prompt_batch returns
+    after the prompt is queued on comfyui and wait_prompt follows it to the
+    end, so the next prompt can be queued while one is running
+    """
+
     def __init__(self) -> None:
         client_id = str(uuid.uuid4())
         super().__init__(client_id)
+        # per backend endpoint, same client_id on every backend
+        self.backend_clients: Dict[str, BasicClient] = {}
+        self.ws_clients: Dict[str, ComfyUIWSClient] = {}
+        self._clients_lock = threading.Lock()
+        self.download_executor = ThreadPoolExecutor(
+            max_workers=ConfigMgr()
+            .get_conf("comfyui")
+            .get("download_concurrency", DEFAULT_DOWNLOAD_CONCURRENCY),
+            thread_name_prefix="ComfyUIDownload",
+        )
 
-        # task scope
-        self.task_id = None
-        self.prompt_json = None
-        self.nodes = []
-        self.nodes_done = []
-        self.cur_exec_node = None
+        # cancel() is called from api threads
+        self._cancel_lock = threading.Lock()
+        self.cancel_task_ids = set()
+        self.prompt_states: List[PromptState] = []
 
-    def _reset_task_info(self, nodes, task_id, prompt_json):
-        self.task_id = task_id
-        self.prompt_json = prompt_json
-        self.nodes = nodes
-        self.nodes_done = []
-        self.cur_exec_node = None
+    def _update_progress(self, state: PromptState, event_data: ComfyUIEventData):
+        # every task served by the prompt gets the progress
+        for task_id in state.task_ids:
+            EventDispatcher().dispatch_event(
+                f"{EVENT_TYPE_INTERNAL_COMFYUI}_{task_id}",
+                event_data.model_copy(update={"task_id": task_id}),
+            )
 
-    def _update_progress(self, event_data: ComfyUIEventData):
-        EventDispatcher().dispatch_event(
-            f"{EVENT_TYPE_INTERNAL_COMFYUI}_{event_data.task_id}",
-            event_data,
+    def _get_backend_client(self, endpoint: str) -> BasicClient:
+        with self._clients_lock:
+            if endpoint not in self.backend_clients:
+                self.backend_clients[endpoint] = BasicClient(self.client_id, endpoint)
+            return self.backend_clients[endpoint]
+
+    def _get_ws_client(self, endpoint: str) -> ComfyUIWSClient:
+        with self._clients_lock:
+            if endpoint not in self.ws_clients:
+                ws_client = ComfyUIWSClient(self.client_id, endpoint)
+                ws_client.start()
+                self.ws_clients[endpoint] = ws_client
+            return self.ws_clients[endpoint]
+
+    def cancel(self, task_id: int):
+        """
+        cancel task_id if it is a task of this client, a pending prompt is
+        deleted from the comfyui queue and a running one is interrupted
+
+        a task not submitted yet is canceled before it reaches comfyui, a
+        coalesced prompt is only stopped when all of its tasks are canceled
+
+        return: False if the prompt could not be stopped on comfyui, the
+        task is canceled here anyway
+        """
+        with self._cancel_lock:
+            self.cancel_task_ids.add(task_id)
+            state = next((s for s in self.prompt_states if task_id in s.task_ids), None)
+            if not self._mark_stopped(state):
+                return True
+        # comfyui requests are slow, not under the lock
+        return self._cancel_prompt(state)
+
+    def preempt(self, state: PromptState) -> bool:
+        """
+        stop a queued prompt for a task of higher priority, wait_prompt
+        raises TaskPreemptedError
+
+        return: False if the prompt is not on comfyui (yet or any more)
+        """
+        with self._cancel_lock:
+            if state not in self.prompt_states or state.stopped:
+                return False
+            state.preempted = True
+            if not self._mark_stopped(state):
+                state.preempted = False
+                return False
+        self._cancel_prompt(state)
+        return True
+
+    def _mark_stopped(self, state: Optional[PromptState]) -> bool:
+        """
+        called under _cancel_lock, wakes up the waiter of a prompt on comfyui
+        which is stopped by preempt or by cancel of all its tasks
+
+        return: False if there is nothing to stop or it is stopped already
+        """
+        if state is None or state.prompt_id is None or state.stopped:
+            return False
+        if not state.preempted and not self._all_canceled(state):
+            return False
+        state.stopped = True
+        state.messages.put({"type": WS_MSG_CANCELED, "data": {}})
+        return True
+
+    def _stopped_error(self, state: PromptState) -> TaskCanceledError:
+        if state.preempted:
+            return TaskPreemptedError(f"task preempted: {state.task_ids}")
+        return TaskCanceledError(f"task canceled: {state.task_ids}")
+
+    def release_tasks(self, task_ids: List[int]):
+        """
+        forget the cancel marks of finished tasks
+        """
+        with self._cancel_lock:
+            self.cancel_task_ids.difference_update(task_ids)
+
+    def inflight_prompts(self) -> int:
+        with self._cancel_lock:
+            return len(self.prompt_states)
+
+    def _all_canceled(self, state: PromptState) -> bool:
+        return len(state.task_ids) != 0 and self.cancel_task_ids.issuperset(
+            state.task_ids
+        )
+
+    def _cancel_prompt(self, state: PromptState) -> bool:
+        """
+        delete the prompt from the comfyui queue, or interrupt it if running
+
+        return: False if a comfyui request failed
+        """
+        prompt_id = state.prompt_id
+        try:
+            # harmless if it started already, then it can not start any more
+            state.backend_client.post_queue_api(delete=[prompt_id])
+            queue = state.backend_client.get_queue_api()
+            if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+                # comfyui ignores an interrupt for another running prompt
+                state.backend_client.post_interrupt_api(prompt_id)
+                logging.info(f"[comfyui]interrupt prompt: {prompt_id}")
+            else:
+                logging.info(f"[comfyui]delete pending prompt: {prompt_id}")
+        except Exception as err:
+            logging.warning(f"[comfyui]cancel prompt {prompt_id} err: {err}")
+            return False
+        return True
+
+    def _check_canceled(self, state: PromptState):
+        with self._cancel_lock:
+            if self._all_canceled(state):
+                raise TaskCanceledError(f"task canceled: {state.task_ids}")
+
+    def queue_prompt(
+        self,
+        task_id: int,
+        prompt_json,
+        result_image_node_id: str = None,
+        output_dir: str = None,
+        input_images: Dict[str, bytes] = None,
+    ) -> List[str]:
+        """
+        run prompt_json on the least loaded backend, images of
+        result_image_node_id are saved into output_dir
+
+        input_images: LoadImage node_id -> image, uploaded to the chosen backend
+
+        return: saved image filenames
+        """
+        results = self.queue_prompt_batch(
+            [task_id], prompt_json, [result_image_node_id], output_dir, input_images
         )
+        return results[result_image_node_id]
 
-    def queue_prompt(self, task_id: int, prompt_json, result_image_node_id: str = None):
+    def queue_prompt_batch(
+        self,
+        task_ids: List[int],
+        prompt_json,
+        result_image_node_ids: List[str],
+        output_dir: str = None,
+        input_images: Dict[str, bytes] = None,
+    ) -> Dict[str, List[str]]:
+        """
+        run one prompt_json which serves several coalesced tasks, progress
+        is sent to every task
 
-        self._reset_task_info(
-            nodes=list(prompt_json.keys()), task_id=task_id, prompt_json=prompt_json
+        return: result node_id -> saved image filenames
+        """
+        state = self.submit_prompt_batch(
+            task_ids, prompt_json, result_image_node_ids, output_dir, input_images
         )
+        return self.wait_prompt(state)
+
+    def submit_prompt_batch(
+        self,
+        task_ids: List[int],
+        prompt_json,
+        result_image_node_ids: List[str],
+        output_dir: str = None,
+        input_images: Dict[str, bytes] = None,
+    ) -> PromptState:
+        """
+        queue prompt_json on a backend which has its models and a free
+        in-flight slot, blocks while every such backend is full
+
+        return: state to pass to wait_prompt, which releases the slot
+        """
+        backend = BackendPool().acquire(
+            lambda b: ObjectInfoCatalog().supports(b.endpoint, prompt_json)
+        )
+        state = PromptState(
+            backend=backend,
+            backend_client=self._get_backend_client(backend.endpoint),
+            task_ids=task_ids,
+            prompt_json=prompt_json,
+            result_image_node_ids=result_image_node_ids,
+            output_dir=output_dir,
+        )
+        with self._cancel_lock:
+            self.prompt_states.append(state)
+        try:
+            self._submit(state, input_images)
+        except Exception as err:
+            self._finish(state)
+            raise err
+        return state
+
+    def _submit(self, state: PromptState, input_images: Dict[str, bytes]):
+        backend = state.backend
+        task_ids = state.task_ids
+
+        # ws must be connected before queue, or comfyui drops the events
+        ws_client = self._get_ws_client(backend.endpoint)
+        if not ws_client.wait_connected(WS_CONNECT_TIMEOUT):
+            logging.warning(
+                f"[comfyui]ws not connected, fallback to history polling, task_id: {state.task_id}"
+            )
 
         # queue
-        prompt_id = self.post_prompt_api(prompt_json).prompt_id
+        self._check_canceled(state)
+        try:
+            self._upload_input_images(state, input_images)
+            prompt_id = state.backend_client.post_prompt_api(
+                state.prompt_json
+            ).prompt_id
+        except (ComfyUIRetryableError, CircuitOpenError) as err:
+            BackendPool().report_failure(backend, err)
+            raise err
+        messages = ws_client.register(prompt_id)
+        with self._cancel_lock:
+            state.prompt_id = prompt_id
+            state.messages = messages
+            state.queued_at = time.time()
+            # canceled while posting
+            canceled = self._mark_stopped(state)
+        if canceled:
+            self._cancel_prompt(state)
+            ws_client.unregister(prompt_id)
+            raise TaskCanceledError(f"task canceled: {task_ids}")
         logging.debug(
-            f"[comfyui]queue done, prompt_id: {prompt_id}, task_id: {task_id}"
+            f"[comfyui]queue done, prompt_id: {prompt_id}, task_ids: {task_ids}, backend: {backend.endpoint}"
         )
         self._update_progress(
+            state,
             ComfyUIEventData(
-                task_id=task_id,
+                task_id=state.task_id,
                 progress_name=ComfyUIProgressName.SUBMIT_TASK,
                 progress_value=1,
                 progress_value_max=1,
-            )
+            ),
         )
 
+    def _finish(self, state: PromptState):
+        # once per state, the backend slot is released here
+        with self._cancel_lock:
+            if state not in self.prompt_states:
+                return
+            self.prompt_states.remove(state)
+        BackendPool().release(state.backend)
+
+    def abandon_prompt(self, state: PromptState):
+        """
+        drop a submitted prompt which will not be waited for
+        """
+        with self._cancel_lock:
+            if state not in self.prompt_states:
+                return
+        try:
+            self._cancel_prompt(state)
+        finally:
+            self._get_ws_client(state.backend.endpoint).unregister(state.prompt_id)
+            self._finish(state)
+
+    def wait_prompt(self, state: PromptState) -> Dict[str, List[str]]:
+        """
+        follow a submitted prompt until it ends and download its images
+
+        return: result node_id -> saved image filenames
+        """
+        try:
+            return self._wait_prompt(state)
+        finally:
+            self._finish(state)
+
+    def _wait_prompt(self, state: PromptState) -> Dict[str, List[str]]:
+        prompt_id = state.prompt_id
+        ws_client = self._get_ws_client(state.backend.endpoint)
+
         # handle progress
-        self._ws_handle_progress(prompt_id)
+        try:
+            self._ws_handle_progress(state)
+        except Exception as err:
+            for futures in state.image_futures.values():
+                self._collect_images(state, futures, ignore_err=True)
+            raise err
+        finally:
+            ws_client.unregister(prompt_id)
+            for tid in state.task_ids:
+                PreviewForwarder().finish(tid)
 
         # get result
-        return self._get_target_node_images(prompt_id, result_image_node_id)
+        results = {}
+        try:
+            for node_id in state.result_image_node_ids:
+                if node_id in state.image_futures:
+                    # downloads already started by executed msg
+                    results[node_id] = self._collect_images(
+                        state, state.image_futures[node_id]
+                    )
+                else:
+                    # executed msg missed or node cached, fallback to history
+                    results[node_id] = self._get_target_node_images(state, node_id)
+        except Exception as err:
+            for node_id, futures in state.image_futures.items():
+                if node_id not in results:
+                    self._collect_images(state, futures, ignore_err=True)
+            for image_filenames in results.values():
+                self._remove_images(state, image_filenames)
+            raise err
+        return results
+
+    def _upload_input_images(self, state: PromptState, input_images: Dict[str, bytes]):
+        # identical images are uploaded to a backend only once
+        for node_id, image in (input_images or {}).items():
+            resp = UploadCache().upload(state.backend_client, image)
+            state.prompt_json[node_id]["inputs"]["image"] = resp.name
+
+    def _update_progress_done(self, state: PromptState):
+        self._update_progress(
+            state,
+            ComfyUIEventData(
+                task_id=state.task_id,
+                progress_name=ComfyUIProgressName.TASK_DOING,
+                progress_tip=f"工作流执行完成",
+                progress_value=len(state.nodes),
+                progress_value_max=len(state.nodes),
+            ),
+        )
 
-    def _ws_handle_progress(self, prompt_id: str):
-        # setup websocket
-        ws = websocket.WebSocket()
-        server_address = ConfigMgr().get_conf("comfyui")["endpoint"]
-        ws.connect(f"ws://{server_address}/ws?clientId={self.client_id}")
-        logging.debug(f"[comfyui]ws connect done, client_id: {self.client_id}")
+    def _is_prompt_done_in_history(self, state: PromptState, history) -> bool:
+        prompt_id = state.prompt_id
+        if prompt_id not in history:
+            return False
+        status = history[prompt_id].get("status", {})
+        if status.get("status_str") == "error":
+            raise Exception(f"history execute error: {prompt_id}, status: {status}")
+        return True
 
+    def _ws_handle_progress(self, state: PromptState):
+        prompt_id = state.prompt_id
+        messages = state.messages
+        poll_failures = 0
         # ws msg
         # execution_start
         # execution_cached
         # (executing + progress x n) or executing
         # executing && node==null
         while True:
-            out = ws.recv()
-            if not isinstance(out, str):
-                continue  # previews are binary data
-            message = json.loads(out)
+            try:
+                message = messages.get(timeout=WS_HISTORY_POLL_SECONDS)
+            except Empty:
+                message = {"type": WS_MSG_RECONNECTED, "data": {}}
             message_type = message["type"]
+            if message_type == WS_MSG_CANCELED:
+                raise self._stopped_error(state)
+            if message_type == WS_MSG_PREVIEW:
+                for task_id in state.task_ids:
+                    PreviewForwarder().submit(task_id, message["data"]["image"])
+                continue
+            if message_type == WS_MSG_RECONNECTED:
+                # ws reconnected or idle, events may have been missed
+                try:
+                    history = state.backend_client.get_history_by_prompt_id_api(
+                        prompt_id
+                    )
+                except Exception as err:
+                    # comfyui busy or restarting, keep waiting for ws messages
+                    poll_failures += 1
+                    logging.warning(
+                        f"[comfyui]history poll {poll_failures}/{WS_HISTORY_POLL_MAX_FAILURES} failed, prompt_id: {prompt_id}, err: {err}"
+                    )
+                    if poll_failures >= WS_HISTORY_POLL_MAX_FAILURES:
+                        raise err
+                    continue
+                poll_failures = 0
+                if self._is_prompt_done_in_history(state, history):
+                    logging.debug(f"history execute done: {prompt_id}")
+                    state.executed_at = time.time()
+                    self._update_progress_done(state)
+                    break
+                continue
             match message_type:
                 case "execution_start":
                     data = message["data"]
                     if data["prompt_id"] != prompt_id:
                         continue
                     logging.info(f"ws execute start: {prompt_id}")
+                    state.started_at = time.time()
                     self._update_progress(
+                        state,
                         ComfyUIEventData(
-                            task_id=self.task_id,
+                            task_id=state.task_id,
                             progress_name=ComfyUIProgressName.TASK_START,
                             progress_value=1,
                             progress_value_max=1,
-                        )
+                        ),
                     )
                     continue
                 case "execution_cached":
@@ -121,7 +534,7 @@ class ComfyUIClient(BasicClient):
                     if data["prompt_id"] != prompt_id:
                         continue
                     logging.debug(f"execution_cached: {data}")
-                    self.nodes_done = data["nodes"]
+                    state.nodes_done = data["nodes"]
                     continue
                 case "executing":
                     data = message["data"]
@@ -130,36 +543,33 @@ class ComfyUIClient(BasicClient):
                         continue
                     if node_id is None:
                         logging.debug(f"ws execute done: {prompt_id}")
+                        state.executed_at = time.time()
+                        self._node_done(state)
                         # websocket miss?
-                        # if len(self.nodes_done) != len(self.nodes):
+                        # if len(state.nodes_done) != len(state.nodes):
                         #     raise Exception(
-                        #         f"task status not expect, nodes_done: {self.nodes_done}, nodes: {self.nodes}"
+                        #         f"task status not expect, nodes_done: {state.nodes_done}, nodes: {state.nodes}"
                         #     )
-                        self._update_progress(
-                            ComfyUIEventData(
-                                task_id=self.task_id,
-                                progress_name=ComfyUIProgressName.TASK_DOING,
-                                progress_tip=f"工作流执行完成",
-                                progress_value=len(self.nodes),
-                                progress_value_max=len(self.nodes),
-                            )
-                        )
+                        self._update_progress_done(state)
                         break
                     logging.debug(f"ws execute doing: {prompt_id}, node_id: {node_id} ")
 
-                    if self.cur_exec_node:
-                        logging.debug(f"node {self.cur_exec_node} exec done")
-                        self.nodes_done.append(self.cur_exec_node)
-                    self.cur_exec_node = node_id
+                    if state.cur_exec_node:
+                        logging.debug(f"node {state.cur_exec_node} exec done")
+                        state.nodes_done.append(state.cur_exec_node)
+                        self._node_done(state)
+                    state.cur_exec_node = node_id
+                    state.node_started_at = time.time()
 
                     self._update_progress(
+                        state,
                         ComfyUIEventData(
-                            task_id=self.task_id,
+                            task_id=state.task_id,
                             progress_name=ComfyUIProgressName.TASK_DOING,
                             progress_tip=f"节点{node_id}开始执行",
-                            progress_value=len(self.nodes_done) + 1,
-                            progress_value_max=len(self.nodes),
-                        )
+                            progress_value=len(state.nodes_done) + 1,
+                            progress_value_max=len(state.nodes),
+                        ),
                     )
                     continue
                 case "progress":
@@ -169,16 +579,17 @@ class ComfyUIClient(BasicClient):
                         continue
                     logging.debug(f"progress: {data}")
                     self._update_progress(
+                        state,
                         ComfyUIEventData(
-                            task_id=self.task_id,
+                            task_id=state.task_id,
                             progress_name=ComfyUIProgressName.TASK_DOING,
                             progress_tip=f"节点{node_id}执行中",
-                            progress_value=len(self.nodes_done) + 1,
-                            progress_value_max=len(self.nodes),
+                            progress_value=len(state.nodes_done) + 1,
+                            progress_value_max=len(state.nodes),
                             node_id=node_id,
                             node_progress_value_max=data["max"],
                             node_progress_value=data["value"],
-                        )
+                        ),
                     )
                     continue
                 case "executed":  # 节点有output
@@ -187,19 +598,35 @@ class ComfyUIClient(BasicClient):
                     if data["prompt_id"] != prompt_id:
                         continue
                     logging.info(f"executed: {data}")
+                    if (
+                        data["node"] in state.result_image_node_ids
+                        and "images" in data["output"]
+                    ):
+                        state.image_futures.setdefault(data["node"], []).extend(
+                            self._download_images(state, data["output"]["images"])
+                        )
                     continue
+                case "execution_interrupted":
+                    data = message["data"]
+                    if data["prompt_id"] != prompt_id:
+                        continue
+                    if state.preempted or self._all_canceled(state):
+                        raise self._stopped_error(state)
+                    # interrupted by someone else on the backend
+                    raise Exception(f"ws execute interrupted: {prompt_id}")
                 case "execution_error":
                     data = message["data"]
                     exception_message = data["exception_message"]
                     self._update_progress(
+                        state,
                         ComfyUIEventData(
-                            task_id=self.task_id,
+                            task_id=state.task_id,
                             progress_name=ComfyUIProgressName.TASK_DOING,
                             progress_tip="执行失败",
-                            progress_value=len(self.nodes_done) + 1,
-                            progress_value_max=len(self.nodes),
+                            progress_value=len(state.nodes_done) + 1,
+                            progress_value_max=len(state.nodes),
                             err_msg=exception_message,
-                        )
+                        ),
                     )
                     raise Exception(
                         f"ws execute error: {prompt_id}, exception_message:   {exception_message}"
@@ -208,17 +635,66 @@ class ComfyUIClient(BasicClient):
                     # TODO: add more
                     continue
         logging.debug(f"[comfyui]exex done, prompt_id: {prompt_id}")
-        ws.close()
 
-    def _get_target_node_images(self, prompt_id, node_id):
+    def _node_done(self, state: PromptState):
+        if state.cur_exec_node is None or state.node_started_at is None:
+            return
+        node = state.prompt_json.get(state.cur_exec_node) or {}
+        state.node_seconds.append(
+            (
+                node.get("class_type", state.cur_exec_node),
+                time.time() - state.node_started_at,
+            )
+        )
+        state.node_started_at = None
+
+    def _get_target_node_images(self, state: PromptState, node_id) -> List[str]:
         logging.debug("[comfyui]_get_target_node_images")
-        history = self.get_history_by_prompt_id_api(prompt_id)[prompt_id]
+        prompt_id = state.prompt_id
+        history = state.backend_client.get_history_by_prompt_id_api(prompt_id)[
+            prompt_id
+        ]
         node_output = history["outputs"][node_id]
+        if "images" not in node_output:
+            return []
+        return self._collect_images(
+            state, self._download_images(state, node_output["images"])
+        )
+
+    def _download_images(self, state: PromptState, images) -> List[Future]:
+        # download concurrently, every image is streamed to its final file
+        backend_client = state.backend_client
+        output_dir = state.output_dir
+
+        def download(image) -> str:
+            image_filename = f"{uuid.uuid4()}.png"
+            backend_client.view_image_to_file_api(
+                f"{output_dir}/{image_filename}",
+                image["filename"],
+                image["type"],
+                image["subfolder"],
+            )
+            return image_filename
+
+        return [self.download_executor.submit(download, image) for image in images]
+
+    def _collect_images(
+        self, state: PromptState, futures: List[Future], ignore_err: bool = False
+    ) -> List[str]:
         images_output = []
-        if "images" in node_output:
-            for image in node_output["images"]:
-                image_data = self.view_image_api(
-                    image["filename"], image["type"], image["subfolder"]
-                )
-                images_output.append(image_data)
+        download_err = None
+        for future in futures:
+            try:
+                images_output.append(future.result())
+            except Exception as err:
+                download_err = err
+        if download_err or ignore_err:
+            # task failed, do not leave orphan files
+            self._remove_images(state, images_output)
+        if download_err and not ignore_err:
+            raise download_err
         return images_output
+
+    def _remove_images(self, state: PromptState, image_filenames: List[str]):
+        for image_filename in image_filenames:
+            os.remove(f"{state.output_dir}/{image_filename}")
@@ -0,0 +1,162 @@
+import threading
+import logging
+import time
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from core.config import ConfigMgr
+from core.comfyui.backend_pool import BackendPool
+
+DEFAULT_OBJECT_INFO_TTL_SECONDS = 300
+OBJECT_INFO_RETRY_SECONDS = 10
+
+# class_type -> input_name -> valid values
+ObjectInfoIndex = Dict[str, Dict[str, FrozenSet[str]]]
+
+
+def build_index(object_info: dict) -> ObjectInfoIndex:
+    """
+    keep only enum inputs of /object_info, e.g.
+    {"KSampler": {"input": {"required": {"sampler_name": [["euler", ...]]}}}}
+    """
+    index = {}
+    for class_type, node_info in object_info.items():
+        inputs = {}
+        for group in ("required", "optional"):
+            for input_name, spec in node_info.get("input", {}).get(group, {}).items():
+                if (
+                    isinstance(spec, list)
+                    and len(spec) > 0
+                    and isinstance(spec[0], list)
+                ):
+                    inputs[input_name] = frozenset(f"{v}" for v in spec[0])
+        if len(inputs) != 0:
+            index[class_type] = inputs
+    return index
+
+
+class ObjectInfoCatalog:
+    """
+    /object_info of every backend, cached for object_info_ttl_seconds and
+    refreshed in background, used to reject bad params before queueing
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        self.ttl = (
+            ConfigMgr()
+            .get_conf("comfyui")
+            .get("object_info_ttl_seconds", DEFAULT_OBJECT_INFO_TTL_SECONDS)
+        )
+        self._mutex = threading.Lock()
+        # endpoint -> (fetched_at, index)
+        self._catalogs: Dict[str, Tuple[float, ObjectInfoIndex]] = {}
+        self.refresh_count = 0
+        self.refresh_failed_count = 0
+        threading.Thread(
+            target=self._refresh_loop, name="ObjectInfoCatalog", daemon=True
+        ).start()
+
+    def enum_values(self, class_type: str, input_name: str) -> Optional[FrozenSet[str]]:
+        """
+        union of valid values over the healthy backends, None if unknown
+        """
+        healthy = {b.endpoint for b in BackendPool().healthy_backends()}
+        values = None
+        with self._mutex:
+            for endpoint, (_, index) in self._catalogs.items():
+                if endpoint not in healthy:
+                    continue
+                backend_values = index.get(class_type, {}).get(input_name)
+                if backend_values is None:
+                    continue
+                values = backend_values if values is None else values | backend_values
+        return values
+
+    def supports(self, endpoint: str, prompt_json: dict) -> bool:
+        """
+        whether the backend has every model file, e.g. ckpt_name, lora_name,
+        named by prompt_json, True if its catalog is not loaded yet
+        """
+        with self._mutex:
+            if endpoint not in self._catalogs:
+                return True
+            _, index = self._catalogs[endpoint]
+        for node in prompt_json.values():
+            inputs = index.get(node.get("class_type"), {})
+            for input_name, value in node.get("inputs", {}).items():
+                if not input_name.endswith("_name") or not isinstance(value, str):
+                    continue
+                values = inputs.get(input_name)
+                if values is not None and value not in values:
+                    return False
+        return True
+
+    def validate(self, params: Dict[Tuple[str, str], str]) -> Optional[str]:
+        """
+        params: (class_type, input_name) -> value
+
+        return: err msg, None if valid or catalog not loaded yet
+        """
+        for (class_type, input_name), value in params.items():
+            values = self.enum_values(class_type, input_name)
+            if values is None or f"{value}" in values:
+                continue
+            return f"invalid {input_name}: {value}, not found in comfyui {class_type}"
+        return None
+
+    def metrics(self) -> dict:
+        with self._mutex:
+            catalogs = {
+                endpoint: {
+                    "age_seconds": round(time.time() - fetched_at, 1),
+                    "node_classes": len(index),
+                }
+                for endpoint, (fetched_at, index) in self._catalogs.items()
+            }
+        return {
+            "catalogs": catalogs,
+            "refresh_count": self.refresh_count,
+            "refresh_failed_count": self.refresh_failed_count,
+        }
+
+    def _refresh(self, endpoint: str, client) -> bool:
+        start_t = time.time()
+        try:
+            index = build_index(client.get_object_info_api())
+        except Exception as err:
+            self.refresh_failed_count += 1
+            logging.warning(f"[comfyui]object_info refresh failed: {endpoint}, {err}")
+            return False
+        with self._mutex:
+            self._catalogs[endpoint] = (time.time(), index)
+        self.refresh_count += 1
+        logging.debug(
+            f"[comfyui]object_info refresh done: {endpoint}, cost {time.time()-start_t}s"
+        )
+        return True
+
+    def _refresh_loop(self):
+        while True:
+            next_refresh = self.ttl
+            for backend in BackendPool().healthy_backends():
+                with self._mutex:
+                    fetched_at, _ = self._catalogs.get(backend.endpoint, (0, None))
+                age = time.time() - fetched_at
+                if age >= self.ttl:
+                    # stale catalog is kept when refresh failed
+                    if not self._refresh(backend.endpoint, backend.client):
+                        next_refresh = min(next_refresh, OBJECT_INFO_RETRY_SECONDS)
+                else:
+                    next_refresh = min(next_refresh, self.ttl - age)
+            time.sleep(max(next_refresh, 1))
@@ -0,0 +1,121 @@
+import base64
+import io
+import logging
+import threading
+import time
+from typing import Dict
+
+from PIL import Image
+
+from core.config import ConfigMgr
+from core.const import *
+from core.models.common import WSEvent
+from core.models.gen_image.ws import TOPIC_GENIMAGE_PREVIEW, GenImageEvent
+from core.server.event import EventDispatcher
+
+DEFAULT_PREVIEW_INTERVAL_SECONDS = 0.5
+DEFAULT_PREVIEW_MAX_SIZE = 256
+DEFAULT_PREVIEW_QUALITY = 70
+
+
+class PreviewForwarder:
+    """
+    forward comfyui latent previews to ws clients
+
+    only the latest frame of every task is kept, it is sent at most once per
+    preview_interval_seconds after being downscaled and re-encoded as jpeg
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        comfyui_conf = ConfigMgr().get_conf("comfyui")
+        self.enable = comfyui_conf.get("preview_enable", True)
+        self.interval = comfyui_conf.get(
+            "preview_interval_seconds", DEFAULT_PREVIEW_INTERVAL_SECONDS
+        )
+        self.max_size = comfyui_conf.get("preview_max_size", DEFAULT_PREVIEW_MAX_SIZE)
+        self.quality = comfyui_conf.get("preview_quality", DEFAULT_PREVIEW_QUALITY)
+
+        self._cond = threading.Condition(threading.Lock())
+        self._latest_frames: Dict[int, bytes] = {}
+        self._last_sent_at: Dict[int, float] = {}
+        self.frames_received = 0
+        self.frames_sent = 0
+
+        if self.enable:
+            threading.Thread(
+                target=self._forward_loop, name="PreviewForwarder", daemon=True
+            ).start()
+
+    def submit(self, task_id: int, image: bytes):
+        if not self.enable:
+            return
+        with self._cond:
+            self.frames_received += 1
+            # older frame not sent yet is stale now
+            self._latest_frames[task_id] = image
+            self._cond.notify()
+
+    def finish(self, task_id: int):
+        with self._cond:
+            self._latest_frames.pop(task_id, None)
+            self._last_sent_at.pop(task_id, None)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "frames_received": self.frames_received,
+                "frames_sent": self.frames_sent,
+            }
+
+    def _next_frame(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = None
+                for task_id in self._latest_frames.keys():
+                    due = self._last_sent_at.get(task_id, 0) + self.interval
+                    if due <= now:
+                        self._last_sent_at[task_id] = now
+                        return task_id, self._latest_frames.pop(task_id)
+                    wait = due - now if wait is None else min(wait, due - now)
+                self._cond.wait(wait)
+
+    def _encode(self, image: bytes) -> str:
+        img = Image.open(io.BytesIO(image))
+        img.thumbnail((self.max_size, self.max_size))
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=self.quality)
+        return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+
+    def _forward_loop(self):
+        while True:
+            task_id, image = self._next_frame()
+            try:
+                preview = self._encode(image)
+            except Exception as err:
+                logging.warning(f"[comfyui]preview encode failed: {err}")
+                continue
+            with self._cond:
+                self.frames_sent += 1
+            EventDispatcher().dispatch_event(
+                EVENT_TYPE_WS_LATEST,
+                (
+                    f"{TOPIC_GENIMAGE_PREVIEW}_{task_id}",
+                    WSEvent(
+                        topic=TOPIC_GENIMAGE_PREVIEW,
+                        data=GenImageEvent.Data(task_id=task_id, preview=preview),
+                    ),
+                ),
+            )
@@ -0,0 +1,251 @@
+import threading
+import logging
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from retry.api import retry_call
+from typing import Dict, Optional
+
+from core.config import ConfigMgr
+
+DEFAULT_HTTP_CONNECT_TIMEOUT = 3
+DEFAULT_HTTP_READ_TIMEOUT = 30
+DEFAULT_HTTP_RETRY_TRIES = 3
+DEFAULT_HTTP_RETRY_DELAY = 0.2
+DEFAULT_HTTP_RETRY_MAX_DELAY = 2
+DEFAULT_HTTP_POOL_MAXSIZE = 32
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 5
+DEFAULT_CIRCUIT_RESET_SECONDS = 30
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class ComfyUIRequestError(Exception):
+    def __init__(self, msg: str, status_code: int = None) -> None:
+        super().__init__(msg)
+        self.status_code = status_code
+
+
+class ComfyUIRetryableError(ComfyUIRequestError):
+    """connection error, timeout or 5xx"""
+
+
+class CircuitOpenError(ComfyUIRequestError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    after failure_threshold consecutive failures the endpoint is rejected
+    for reset_seconds, then one trial request decides to close or reopen
+    """
+
+    def __init__(self, endpoint: str, failure_threshold: int, reset_seconds: float):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        self._lock = threading.Lock()
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN:
+                if time.time() - self.opened_at < self.reset_seconds:
+                    self.rejected += 1
+                    return False
+                self.state = CIRCUIT_HALF_OPEN
+                return True
+            # half open, trial request in flight
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or (
+                self.state == CIRCUIT_CLOSED and self.failures >= self.failure_threshold
+            ):
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.time()
+                self.trips += 1
+                logging.warning(
+                    f"[comfyui]circuit open, endpoint: {self.endpoint}, failures: {self.failures}"
+                )
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+
+
+class HttpTransport:
+    """
+    shared requests.Session for every BasicClient, with timeouts, jittered
+    backoff retries for idempotent requests and a circuit breaker per
+    endpoint
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        comfyui_conf = ConfigMgr().get_conf("comfyui")
+        self.timeout = (
+            comfyui_conf.get("http_connect_timeout", DEFAULT_HTTP_CONNECT_TIMEOUT),
+            comfyui_conf.get("http_read_timeout", DEFAULT_HTTP_READ_TIMEOUT),
+        )
+        self.retry_tries = comfyui_conf.get(
+            "http_retry_tries", DEFAULT_HTTP_RETRY_TRIES
+        )
+        self.retry_delay = comfyui_conf.get(
+            "http_retry_delay", DEFAULT_HTTP_RETRY_DELAY
+        )
+        self.retry_max_delay = comfyui_conf.get(
+            "http_retry_max_delay", DEFAULT_HTTP_RETRY_MAX_DELAY
+        )
+        self.circuit_failure_threshold = comfyui_conf.get(
+            "circuit_failure_threshold", DEFAULT_CIRCUIT_FAILURE_THRESHOLD
+        )
+        self.circuit_reset_seconds = comfyui_conf.get(
+            "circuit_reset_seconds", DEFAULT_CIRCUIT_RESET_SECONDS
+        )
+
+        pool_maxsize = comfyui_conf.get("http_pool_maxsize", DEFAULT_HTTP_POOL_MAXSIZE)
+        adapter = HTTPAdapter(
+            pool_connections=len(comfyui_conf.get("endpoints") or []) + 1,
+            pool_maxsize=pool_maxsize,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._metrics_lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        with self._metrics_lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(
+                    endpoint,
+                    self.circuit_failure_threshold,
+                    self.circuit_reset_seconds,
+                )
+            return self._breakers[endpoint]
+
+    def request(
+        self,
+        method: str,
+        endpoint: str,
+        path: str,
+        api_name: str,
+        idempotent: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        tries: Optional[int] = None,
+        **kwargs,
+    ) -> requests.Response:
+        """
+        idempotent: retry on connection error/timeout/5xx, default True for GET
+        timeout, tries: instead of the configured ones, e.g. for health checks
+        """
+        if idempotent is None:
+            idempotent = method == "GET"
+        breaker = self.breaker(endpoint)
+        attempts = [0]
+
+        def do_request() -> requests.Response:
+            attempts[0] += 1
+            if attempts[0] > 1:
+                with self._metrics_lock:
+                    self.retries += 1
+            if not breaker.allow():
+                raise CircuitOpenError(f"{api_name} failed, circuit open: {endpoint}")
+            with self._metrics_lock:
+                self.requests += 1
+            try:
+                resp = self.session.request(
+                    method,
+                    f"http://{endpoint}{path}",
+                    timeout=timeout or self.timeout,
+                    **kwargs,
+                )
+            except (requests.ConnectionError, requests.Timeout) as err:
+                breaker.record_failure()
+                raise ComfyUIRetryableError(f"{api_name} failed: {err}")
+            except BaseException as err:
+                # e.g. ChunkedEncodingError, a half open trial must not stay in flight
+                breaker.record_failure()
+                raise err
+            if resp.status_code >= 500:
+                breaker.record_failure()
+                raise ComfyUIRetryableError(
+                    f"{api_name} failed, status_code: {resp.status_code}, {self._body(resp)}",
+                    resp.status_code,
+                )
+            breaker.record_success()
+            if resp.status_code != 200:
+                raise ComfyUIRequestError(
+                    f"{api_name} failed, status_code: {resp.status_code}, {self._body(resp)}",
+                    resp.status_code,
+                )
+            return resp
+
+        try:
+            return retry_call(
+                do_request,
+                exceptions=ComfyUIRetryableError,
+                tries=tries or (self.retry_tries if idempotent else 1),
+                delay=self.retry_delay,
+                max_delay=self.retry_max_delay,
+                backoff=2,
+                jitter=(0, self.retry_delay),
+                logger=None,
+            )
+        except ComfyUIRequestError as err:
+            with self._metrics_lock:
+                self.failures += 1
+            raise err
+
+    @staticmethod
+    def _body(resp: requests.Response) -> str:
+        # error body is not always json
+        return resp.text[:512]
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            breakers = list(self._breakers.values())
+            metrics = {
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+            }
+        metrics["circuits"] = {b.endpoint: b.metrics() for b in breakers}
+        return metrics
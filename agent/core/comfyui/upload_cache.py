@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import threading
+import time
+from expiringdict import ExpiringDict
+
+from core.config import ConfigMgr
+from core.comfyui.basic_client import BasicClient, UploadImageResponse
+
+DEFAULT_UPLOAD_CACHE_MAX_LEN = 1024
+DEFAULT_UPLOAD_CACHE_MAX_AGE_SECONDS = 24 * 3600
+# cache hits older than this are checked with HEAD /view before reuse
+DEFAULT_UPLOAD_CACHE_VERIFY_SECONDS = 60
+
+
+class UploadCache:
+    """
+    input images uploaded to comfyui, keyed by backend and sha256 of content
+
+    files are uploaded under a content derived name, so a byte-identical
+    file on the backend is referenced by name instead of uploaded again
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        comfyui_conf = ConfigMgr().get_conf("comfyui")
+        # (endpoint, sha256) -> (UploadImageResponse, verified_at)
+        self._cache = ExpiringDict(
+            max_len=comfyui_conf.get(
+                "upload_cache_max_len", DEFAULT_UPLOAD_CACHE_MAX_LEN
+            ),
+            max_age_seconds=comfyui_conf.get(
+                "upload_cache_max_age_seconds", DEFAULT_UPLOAD_CACHE_MAX_AGE_SECONDS
+            ),
+        )
+        self.verify_seconds = comfyui_conf.get(
+            "upload_cache_verify_seconds", DEFAULT_UPLOAD_CACHE_VERIFY_SECONDS
+        )
+        self._metrics_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.bytes_saved = 0
+
+    def upload(
+        self, client: BasicClient, image: bytes, ext: str = "png"
+    ) -> UploadImageResponse:
+        digest = hashlib.sha256(image).hexdigest()
+        key = (client.server_address, digest)
+
+        cached = self._cache.get(key)
+        if cached:
+            resp, verified_at = cached
+            if time.time() - verified_at < self.verify_seconds or (
+                client.check_image_api(resp.name, resp.type, resp.subfolder)
+            ):
+                self._cache[key] = (resp, time.time())
+                self._count(hit=True, saved=len(image))
+                return resp
+
+        # not cached or deleted on comfyui
+        filename = f"mox_{digest[:32]}.{ext}"
+        if client.check_image_api(filename, "input"):
+            resp = UploadImageResponse(name=filename, subfolder="", type="input")
+            self._count(hit=True, saved=len(image))
+        else:
+            resp = client.upload_image_api(image, filename, overwrite=True)
+            self._count(hit=False)
+            logging.debug(
+                f"[comfyui]upload image done: {resp.name}, backend: {client.server_address}"
+            )
+        self._cache[key] = (resp, time.time())
+        return resp
+
+    def _count(self, hit: bool, saved: int = 0):
+        with self._metrics_lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += saved
+            else:
+                self.misses += 1
+                self.uploads += 1
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            return {
+                "size": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "uploads": self.uploads,
+                "bytes_saved": self.bytes_saved,
+            }
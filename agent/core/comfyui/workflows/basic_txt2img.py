@@ -1,11 +1,19 @@
 import logging
-from typing import Optional, List
+from typing import Dict, Optional, List
 from pydantic import BaseModel
-import json
 import traceback
 import random
 
-from core.comfyui.comfyui_client import ComfyUIClient
+from core.comfyui.comfyui_client import (
+    ComfyUIClient,
+    PromptState,
+    TaskCanceledError,
+    TaskPreemptedError,
+)
+from core.comfyui.object_info import ObjectInfoCatalog
+from core.comfyui.workflows.registry import WorkflowRegistry, combine_prompts
+from core.storage.storage_mgr import StorageMgr
+from core.storage.result_cache import ResultCache
 
 
 class BasicTxt2imgTask(BaseModel):
@@ -24,34 +32,68 @@ class BasicTxt2imgTask(BaseModel):
     batch_size: int = 4
     width: Optional[int] = 1024
     height: Optional[int] = 1024
+    # first image of the task in the latent batch of seed, a rerun with the
+    # same seed and batch_index gives the same images
+    batch_index: Optional[int] = 0
 
 
 class BasicTxt2imgTaskResult(BasicTxt2imgTask):
-    images: Optional[List[bytes]] = None
+    # saved in StorageMgr().output_file_dir
+    image_filenames: Optional[List[str]] = None
     err_msg: Optional[str] = None
 
 
-def run(
-    comfyui_client: ComfyUIClient, task: BasicTxt2imgTask
-) -> BasicTxt2imgTaskResult:
-    logging.info(
-        f"BasicTxt2imgTask run start, \
-        task_id: {task.task_id} \
-        prompt: {task.prompt}, \
-        ckpt_name: {task.ckpt_name}, \
-        negative_prompt: {task.negative_prompt} \
-        seed: {task.seed}, \
-        steps: {task.steps}, \
-        cfg: {task.cfg}, \
-        sampler_name: {task.sampler_name}, \
-        scheduler: {task.scheduler}, \
-        denoise: {task.denoise}, \
-        batch_size: {task.batch_size}, \
-        width: {task.width}, \
-        height: {task.height}"
+def validate(ckpt_name: str, sampler_name: str, scheduler: str) -> Optional[str]:
+    """
+    check params against the cached comfyui object_info, empty means default
+    """
+    params = {}
+    if ckpt_name:
+        params[("CheckpointLoaderSimple", "ckpt_name")] = ckpt_name
+    if sampler_name:
+        params[("KSampler", "sampler_name")] = sampler_name
+    if scheduler:
+        params[("KSampler", "scheduler")] = scheduler
+    return ObjectInfoCatalog().validate(params)
+
+
+def coalesce_key(task) -> tuple:
+    """
+    tasks with the same key, prompts and random seed can share one latent
+    batch of one comfyui prompt
+    """
+    return (
+        task.ckpt_name,
+        task.width,
+        task.height,
+        task.steps,
+        task.cfg,
+        task.sampler_name,
+        task.scheduler,
+        task.denoise,
     )
 
-    # check default
+
+def _branches(tasks: List[BasicTxt2imgTask]) -> List[List[BasicTxt2imgTask]]:
+    # same prompts and random seed, one latent batch is enough for all
+    branches = []
+    for task in tasks:
+        for branch in branches:
+            first = branch[0]
+            if (
+                task.seed == 0
+                and first.seed == 0
+                and task.prompt == first.prompt
+                and task.negative_prompt == first.negative_prompt
+            ):
+                branch.append(task)
+                break
+        else:
+            branches.append([task])
+    return branches
+
+
+def _fill_defaults(task: BasicTxt2imgTask):
     task.ckpt_name = (
         "juggernautXL_v9Rdphoto2Lightning.safetensors"
         if task.ckpt_name == ""
@@ -67,45 +109,141 @@ def run(
     task.width = 1024 if task.width == 0 else task.width
     task.height = 1024 if task.height == 0 else task.height
 
-    # workflow
-    with open("resource/comfyui_workflows/basic_txt2img.json", "rb") as f:
-        prompt_json = json.load(f)
-
-    # ckpt_name
-    prompt_json["4"]["inputs"]["ckpt_name"] = task.ckpt_name
-    # prompt
-    prompt_json["6"]["inputs"]["text"] = task.prompt
-    # negative prompt
-    prompt_json["7"]["inputs"]["text"] = task.negative_prompt
-    # batch_size
-    prompt_json["5"]["inputs"]["batch_size"] = task.batch_size
-    # width
-    prompt_json["5"]["inputs"]["width"] = task.width
-    # height
-    prompt_json["5"]["inputs"]["height"] = task.height
-    # KSampler
-    prompt_json["3"]["inputs"]["seed"] = task.seed
-    prompt_json["3"]["inputs"]["steps"] = task.steps
-    prompt_json["3"]["inputs"]["cfg"] = task.cfg
-    prompt_json["3"]["inputs"]["sampler_name"] = task.sampler_name
-    prompt_json["3"]["inputs"]["scheduler"] = task.scheduler
-    prompt_json["3"]["inputs"]["denoise"] = task.denoise
 
-    # queue prompt
-    try:
-        comfyui_result = comfyui_client.queue_prompt(
-            task.task_id, prompt_json, result_image_node_id="10"
-        )
-    except Exception as err:
-        traceback.print_exc()
-        return BasicTxt2imgTaskResult(
-            err_msg=f"comfyui queue prompt failed: {err}",
-            task_id=task.task_id,
-            prompt=task.prompt,
+class BasicTxt2imgBatch:
+    """
+    tasks submitted by submit_batch, finished by wait_batch
+    """
+
+    def __init__(self, tasks: List[BasicTxt2imgTask]) -> None:
+        self.tasks = tasks
+        # fixed seed, same params give the same images
+        self.fixed_seed_task_ids = {task.task_id for task in tasks if task.seed != 0}
+        self.results: Dict[int, BasicTxt2imgTaskResult] = {}
+        self.pending_tasks: List[BasicTxt2imgTask] = []
+        self.branches: List[List[BasicTxt2imgTask]] = []
+        self.result_image_node_ids: List[str] = []
+        self.prompt_state: PromptState = None
+        self.canceled_err: TaskCanceledError = None
+
+
+def run(
+    comfyui_client: ComfyUIClient, task: BasicTxt2imgTask
+) -> BasicTxt2imgTaskResult:
+    return run_batch(comfyui_client, [task])[0]
+
+
+def run_batch(
+    comfyui_client: ComfyUIClient, tasks: List[BasicTxt2imgTask]
+) -> List[BasicTxt2imgTaskResult]:
+    """
+    run tasks of the same coalesce_key as one comfyui prompt, tasks with the
+    same prompts and a random seed share one latent batch
+
+    return: result of every task, same order as tasks
+    """
+    return wait_batch(comfyui_client, submit_batch(comfyui_client, tasks))
+
+
+def submit_batch(
+    comfyui_client: ComfyUIClient, tasks: List[BasicTxt2imgTask]
+) -> BasicTxt2imgBatch:
+    """
+    serve tasks from the result cache and queue the others on comfyui,
+    returns once the prompt is queued
+    """
+    for task in tasks:
+        logging.info(
+            f"BasicTxt2imgTask run start, \
+            task_id: {task.task_id} \
+            prompt: {task.prompt}, \
+            ckpt_name: {task.ckpt_name}, \
+            negative_prompt: {task.negative_prompt} \
+            seed: {task.seed}, \
+            steps: {task.steps}, \
+            cfg: {task.cfg}, \
+            sampler_name: {task.sampler_name}, \
+            scheduler: {task.scheduler}, \
+            denoise: {task.denoise}, \
+            batch_size: {task.batch_size}, \
+            width: {task.width}, \
+            height: {task.height}"
         )
-    logging.info(f"BasicTxt2imgTask get images len: {len(comfyui_result)}")
+
+    batch = BasicTxt2imgBatch(tasks)
+    for task in tasks:
+        if task.task_id not in batch.fixed_seed_task_ids:
+            continue
+        _fill_defaults(task)
+        image_filenames = ResultCache().get(_cache_params(task))
+        if image_filenames:
+            logging.info(f"BasicTxt2imgTask result cache hit, task_id: {task.task_id}")
+            batch.results[task.task_id] = _result(task, image_filenames)
+
+    batch.pending_tasks = [task for task in tasks if task.task_id not in batch.results]
+    if len(batch.pending_tasks) != 0:
+        try:
+            _submit_comfyui(comfyui_client, batch)
+        except TaskCanceledError as err:
+            if len(batch.results) == 0:
+                raise err
+            # cached ones are done, the worker knows the canceled ones
+            batch.canceled_err = err
+    return batch
+
+
+def wait_batch(
+    comfyui_client: ComfyUIClient, batch: BasicTxt2imgBatch
+) -> List[BasicTxt2imgTaskResult]:
+    """
+    return: result of every task, same order as tasks
+    """
+    if len(batch.pending_tasks) != 0:
+        try:
+            if batch.canceled_err:
+                raise batch.canceled_err
+            batch.results.update(_wait_comfyui(comfyui_client, batch))
+        except TaskPreemptedError as err:
+            # pending tasks run again, results of cached ones stay in batch
+            raise err
+        except TaskCanceledError as err:
+            if len(batch.results) == 0:
+                raise err
+            for task in batch.pending_tasks:
+                batch.results[task.task_id] = BasicTxt2imgTaskResult(
+                    err_msg=f"{err}", task_id=task.task_id, prompt=task.prompt
+                )
+        for task in batch.pending_tasks:
+            result = batch.results[task.task_id]
+            if task.task_id in batch.fixed_seed_task_ids and result.err_msg is None:
+                ResultCache().put(_cache_params(task), result.image_filenames)
+    return [batch.results[task.task_id] for task in batch.tasks]
+
+
+def _cache_params(task: BasicTxt2imgTask) -> dict:
+    return {
+        "prompt": task.prompt,
+        "negative_prompt": task.negative_prompt,
+        "width": task.width,
+        "height": task.height,
+        "seed": task.seed,
+        "steps": task.steps,
+        "cfg": task.cfg,
+        "sampler_name": task.sampler_name,
+        "scheduler": task.scheduler,
+        "denoise": task.denoise,
+        "ckpt_name": task.ckpt_name,
+        "batch_size": task.batch_size,
+        # only when set, keys of earlier results stay the same
+        **({"batch_index": task.batch_index} if task.batch_index else {}),
+    }
+
+
+def _result(
+    task: BasicTxt2imgTask, image_filenames: List[str]
+) -> BasicTxt2imgTaskResult:
     return BasicTxt2imgTaskResult(
-        images=comfyui_result,
+        image_filenames=image_filenames,
         task_id=task.task_id,
         prompt=task.prompt,
         ckpt_name=task.ckpt_name,
@@ -119,4 +257,114 @@ def run(
         batch_size=task.batch_size,
         width=task.width,
         height=task.height,
+        batch_index=task.batch_index,
     )
+
+
+def _failed_results(
+    tasks: List[BasicTxt2imgTask], err: Exception
+) -> Dict[int, BasicTxt2imgTaskResult]:
+    return {
+        task.task_id: BasicTxt2imgTaskResult(
+            err_msg=f"comfyui queue prompt failed: {err}",
+            task_id=task.task_id,
+            prompt=task.prompt,
+        )
+        for task in tasks
+    }
+
+
+def _submit_comfyui(comfyui_client: ComfyUIClient, batch: BasicTxt2imgBatch):
+    tasks = batch.pending_tasks
+    # check default
+    branches = _branches(tasks)
+    for task in tasks:
+        _fill_defaults(task)
+
+    # workflow, tasks of a branch take their images one after another from
+    # the latent batch of its seed
+    workflow = WorkflowRegistry().get("basic_txt2img")
+    prompts = []
+    for branch in branches:
+        first = branch[0]
+        batch_index = first.batch_index or 0
+        offset = batch_index
+        for task in branch:
+            task.seed = first.seed
+            task.batch_index = offset
+            offset += task.batch_size
+        prompts.append(
+            workflow.build(
+                {
+                    "ckpt_name": first.ckpt_name,
+                    "prompt": first.prompt,
+                    "negative_prompt": first.negative_prompt,
+                    # noise of images batch_index.. does not depend on the
+                    # images before them, those are not sampled
+                    "batch_size": offset,
+                    "batch_index": batch_index,
+                    "batch_length": offset - batch_index,
+                    "width": first.width,
+                    "height": first.height,
+                    "seed": first.seed,
+                    "steps": first.steps,
+                    "cfg": first.cfg,
+                    "sampler_name": first.sampler_name,
+                    "scheduler": first.scheduler,
+                    "denoise": first.denoise,
+                }
+            )
+        )
+    if len(prompts) == 1:
+        prompt_json = prompts[0]
+        result_image_node_ids = [workflow.result_image_node_id]
+    else:
+        prompt_json, id_maps = combine_prompts(prompts, workflow.shared_node_ids)
+        result_image_node_ids = [
+            id_map[workflow.result_image_node_id] for id_map in id_maps
+        ]
+    batch.branches = branches
+    batch.result_image_node_ids = result_image_node_ids
+
+    # queue prompt
+    try:
+        batch.prompt_state = comfyui_client.submit_prompt_batch(
+            [task.task_id for task in tasks],
+            prompt_json,
+            result_image_node_ids=result_image_node_ids,
+            output_dir=StorageMgr().output_file_dir,
+        )
+    except TaskCanceledError as err:
+        # not a failure, let the worker mark it canceled
+        raise err
+    except Exception as err:
+        traceback.print_exc()
+        batch.results.update(_failed_results(tasks, err))
+        batch.pending_tasks = []
+
+
+def _wait_comfyui(
+    comfyui_client: ComfyUIClient, batch: BasicTxt2imgBatch
+) -> Dict[int, BasicTxt2imgTaskResult]:
+    try:
+        comfyui_result = comfyui_client.wait_prompt(batch.prompt_state)
+    except TaskCanceledError as err:
+        raise err
+    except Exception as err:
+        traceback.print_exc()
+        return _failed_results(batch.pending_tasks, err)
+
+    # split every branch batch back to its tasks
+    results = {}
+    for branch, node_id in zip(batch.branches, batch.result_image_node_ids):
+        image_filenames = comfyui_result[node_id]
+        logging.info(
+            f"BasicTxt2imgTask get images len: {len(image_filenames)}, tasks: {[task.task_id for task in branch]}"
+        )
+        offset = 0
+        for task in branch:
+            results[task.task_id] = _result(
+                task, image_filenames[offset : offset + task.batch_size]
+            )
+            offset += task.batch_size
+    return results
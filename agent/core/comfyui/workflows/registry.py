@@ -0,0 +1,301 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+WORKFLOW_DIR = "resource/comfyui_workflows"
+# files are stat'ed at most once per this many seconds
+WORKFLOW_RELOAD_CHECK_SECONDS = 2
+
+# param -> [(node_id, input_name), ...]
+WorkflowBindings = Dict[str, List[Tuple[str, str]]]
+
+
+def _ksampler(*node_ids: str) -> WorkflowBindings:
+    # denoise only goes to the first sampler, later ones refine its output
+    inputs = ["seed", "steps", "cfg", "sampler_name", "scheduler"]
+    bindings = {name: [(node_id, name) for node_id in node_ids] for name in inputs}
+    bindings["denoise"] = [(node_ids[0], "denoise")]
+    return bindings
+
+
+def _text(positive: str, negative: str) -> WorkflowBindings:
+    return {"prompt": [(positive, "text")], "negative_prompt": [(negative, "text")]}
+
+
+def _latent(node_id: str) -> WorkflowBindings:
+    return {
+        "width": [(node_id, "width")],
+        "height": [(node_id, "height")],
+        "batch_size": [(node_id, "batch_size")],
+    }
+
+
+# declaration of every workflow json, params are bound to node inputs,
+# images: param -> LoadImage node id, uploaded by ComfyUIClient
+# shared_nodes: nodes kept once when prompts are combined, e.g. ckpt loader
+WORKFLOW_DECLARATIONS = {
+    "basic_txt2img": {
+        "result_image_node_id": "10",
+        "shared_nodes": ["4"],
+        "params": {
+            "ckpt_name": [("4", "ckpt_name")],
+            **_text("6", "7"),
+            **_latent("5"),
+            # images batch_index.. of the latent batch of seed
+            "batch_index": [("11", "batch_index")],
+            "batch_length": [("11", "length")],
+            **_ksampler("3"),
+        },
+    },
+    "basic_img2img": {
+        "result_image_node_id": "15",
+        "params": {
+            "ckpt_name": [("4", "ckpt_name")],
+            **_text("6", "7"),
+            "batch_size": [("14", "amount")],
+            **_ksampler("3"),
+        },
+        "images": {"image": "11"},
+    },
+    "basic_inpainting": {
+        "result_image_node_id": "19",
+        "params": {
+            "ckpt_name": [("4", "ckpt_name")],
+            **_text("6", "7"),
+            "batch_size": [("16", "amount")],
+            "grow_mask_by": [("12", "grow_mask_by")],
+            # "18" refines the result of "3" with its own low denoise
+            **_ksampler("3", "18"),
+        },
+        "images": {"image": "10"},
+    },
+    "basic_outpainting": {
+        "result_image_node_id": "17",
+        "params": {
+            "ckpt_name": [("4", "ckpt_name")],
+            **_text("6", "7"),
+            "batch_size": [("16", "amount")],
+            "left": [("11", "left")],
+            "top": [("11", "top")],
+            "right": [("11", "right")],
+            "bottom": [("11", "bottom")],
+            "feathering": [("11", "feathering")],
+            **_ksampler("3"),
+        },
+        "images": {"image": "10"},
+    },
+    "basic_instantid": {
+        "result_image_node_id": "36",
+        "params": {
+            "ckpt_name": [("23", "ckpt_name")],
+            **_text("19", "20"),
+            **_latent("18"),
+            "weight": [("31", "weight")],
+            **_ksampler("17"),
+        },
+        "images": {"image": "35"},
+    },
+    "controlnet_dwpose": {
+        "result_image_node_id": "19",
+        "params": {
+            "ckpt_name": [("4", "ckpt_name")],
+            **_text("6", "7"),
+            **_latent("5"),
+            "strength": [("10", "strength")],
+            **_ksampler("3"),
+        },
+        "images": {"image": "12"},
+    },
+    "controlnet_openpose": {
+        "result_image_node_id": "14",
+        "params": {
+            "ckpt_name": [("4", "ckpt_name")],
+            **_text("6", "7"),
+            **_latent("5"),
+            "strength": [("10", "strength")],
+            **_ksampler("3"),
+        },
+        "images": {"image": "12"},
+    },
+    "pixel_upscale": {
+        "result_image_node_id": "17",
+        "params": {
+            "ckpt_name": [("4", "ckpt_name")],
+            **_text("6", "7"),
+            "batch_size": [("16", "amount")],
+            "scale_by": [("12", "scale_by")],
+            **_ksampler("3"),
+        },
+        "images": {"image": "11"},
+    },
+    "simple_upscale": {
+        "result_image_node_id": "12",
+        "params": {
+            "upscale_method": [("10", "upscale_method")],
+            "scale_by": [("10", "scale_by")],
+        },
+        "images": {"image": "11"},
+    },
+}
+
+
+class WorkflowTemplate:
+    def __init__(
+        self, name: str, path: str, mtime: float, nodes: dict, declaration: dict
+    ) -> None:
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.nodes = nodes
+        self.result_image_node_id: str = declaration.get("result_image_node_id")
+        self.bindings: WorkflowBindings = declaration.get("params", {})
+        self.image_nodes: Dict[str, str] = declaration.get("images", {})
+        self.shared_node_ids: List[str] = declaration.get("shared_nodes", [])
+        self._check()
+
+    def _check(self):
+        for param, paths in self.bindings.items():
+            for node_id, input_name in paths:
+                if input_name not in self.nodes.get(node_id, {}).get("inputs", {}):
+                    raise Exception(
+                        f"workflow {self.name} bad binding: {param} -> {node_id}.{input_name}"
+                    )
+        for node_id in [
+            self.result_image_node_id,
+            *self.image_nodes.values(),
+            *self.shared_node_ids,
+        ]:
+            if node_id not in self.nodes:
+                raise Exception(f"workflow {self.name} node not found: {node_id}")
+
+    def build(self, params: dict) -> dict:
+        """
+        copy of the template with params applied, None values keep the
+        template default
+
+        only node dicts and their inputs are copied, links and _meta are
+        shared with the template and must not be modified
+        """
+        prompt_json = {
+            node_id: {**node, "inputs": dict(node["inputs"])}
+            for node_id, node in self.nodes.items()
+        }
+        for param, value in params.items():
+            if param not in self.bindings:
+                raise Exception(f"workflow {self.name} has no param: {param}")
+            if value is None:
+                continue
+            for node_id, input_name in self.bindings[param]:
+                prompt_json[node_id]["inputs"][input_name] = value
+        return prompt_json
+
+
+def combine_prompts(
+    prompts: List[dict], shared_node_ids: List[str]
+) -> Tuple[dict, List[Dict[str, str]]]:
+    """
+    put several prompts built from one template into a single prompt,
+    shared nodes are taken from the first prompt and every other node is
+    renamed to f"{node_id}_{index}" with its links
+
+    return: combined prompt, node_id maps of every prompt
+    """
+    combined = {}
+    id_maps = []
+    for index, prompt_json in enumerate(prompts):
+        id_map = {
+            node_id: node_id if node_id in shared_node_ids else f"{node_id}_{index}"
+            for node_id in prompt_json.keys()
+        }
+        for node_id, node in prompt_json.items():
+            if node_id in shared_node_ids and index != 0:
+                continue
+            inputs = {}
+            for input_name, value in node["inputs"].items():
+                if isinstance(value, list) and len(value) == 2 and value[0] in id_map:
+                    # link: [node_id, output_index]
+                    value = [id_map[value[0]], value[1]]
+                inputs[input_name] = value
+            combined[id_map[node_id]] = {**node, "inputs": inputs}
+        id_maps.append(id_map)
+    return combined, id_maps
+
+
+class WorkflowRegistry:
+    """
+    every workflow json under WORKFLOW_DIR, parsed once and reloaded when
+    the file changes
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        self._mutex = threading.Lock()
+        self._templates: Dict[str, WorkflowTemplate] = {}
+        # name -> mtime of a file which failed to load, not retried until changed
+        self._failed_mtimes: Dict[str, float] = {}
+        self._checked_at = 0.0
+        self.load_count = 0
+        self.load_failed_count = 0
+        self._reload()
+
+    def get(self, name: str) -> WorkflowTemplate:
+        with self._mutex:
+            if time.time() - self._checked_at >= WORKFLOW_RELOAD_CHECK_SECONDS:
+                self._reload()
+            if name not in self._templates:
+                raise Exception(f"workflow not found: {name}")
+            return self._templates[name]
+
+    def names(self) -> List[str]:
+        with self._mutex:
+            return list(self._templates.keys())
+
+    def metrics(self) -> dict:
+        with self._mutex:
+            return {
+                "workflows": list(self._templates.keys()),
+                "load_count": self.load_count,
+                "load_failed_count": self.load_failed_count,
+            }
+
+    def _reload(self):
+        self._checked_at = time.time()
+        for path in glob.glob(f"{WORKFLOW_DIR}/*.json"):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name not in WORKFLOW_DECLARATIONS:
+                continue
+            mtime = os.path.getmtime(path)
+            template = self._templates.get(name)
+            if template and template.mtime == mtime:
+                continue
+            if self._failed_mtimes.get(name) == mtime:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    nodes = json.load(f)
+                self._templates[name] = WorkflowTemplate(
+                    name, path, mtime, nodes, WORKFLOW_DECLARATIONS[name]
+                )
+            except Exception as err:
+                # keep the last good template
+                self.load_failed_count += 1
+                self._failed_mtimes[name] = mtime
+                logging.error(f"[comfyui]load workflow failed: {path}, {err}")
+                continue
+            self.load_count += 1
+            logging.info(f"[comfyui]load workflow done: {name}")
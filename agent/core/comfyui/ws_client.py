@@ -0,0 +1,158 @@
+import websocket  # NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
+import json
+import struct
+import time
+import logging
+import threading
+from queue import Queue
+from collections import OrderedDict
+from typing import Dict, List
+
+from core.config import ConfigMgr
+
+# synthetic message put to every in-flight prompt queue after a reconnect,
+# consumers should check /history because events may have been missed
+WS_MSG_RECONNECTED = "agent_ws_reconnected"
+# binary preview frame, routed to the prompt which is executing on this ws
+WS_MSG_PREVIEW = "agent_ws_preview"
+
+# comfyui binary framing: event(uint32 BE) + image_type(uint32 BE) + image
+WS_BINARY_EVENT_PREVIEW_IMAGE = 1
+WS_PREVIEW_IMAGE_TYPES = {1: "JPEG", 2: "PNG"}
+
+WS_RECONNECT_DELAY_MIN = 0.5
+WS_RECONNECT_DELAY_MAX = 10
+# messages for prompt ids which are not registered yet (post_prompt_api not returned)
+WS_ORPHAN_PROMPTS_MAX = 64
+
+
+class ComfyUIWSClient(threading.Thread):
+    """
+    One long-lived websocket per client_id, messages are routed to the
+    in-flight prompt by prompt_id
+    """
+
+    def __init__(self, client_id: str, server_address: str = None) -> None:
+        threading.Thread.__init__(self, name=f"ComfyUIWSClient-{client_id[:8]}")
+        self.daemon = True
+        self.client_id = client_id
+        self._server_address = server_address
+
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._prompts: Dict[str, Queue] = {}
+        self._orphans: OrderedDict[str, List[dict]] = OrderedDict()
+        self._running_prompt_id = None
+
+        self.connect_count = 0
+
+    @property
+    def server_address(self) -> str:
+        if self._server_address:
+            return self._server_address
+        return ConfigMgr().get_conf("comfyui")["endpoint"]
+
+    def is_connected(self) -> bool:
+        return self._connected.is_set()
+
+    def wait_connected(self, timeout: float = None) -> bool:
+        return self._connected.wait(timeout)
+
+    def register(self, prompt_id: str) -> Queue:
+        """
+        start receiving messages of prompt_id, messages arrived before
+        register are replayed to the returned queue
+        """
+        q = Queue()
+        with self._lock:
+            for message in self._orphans.pop(prompt_id, []):
+                q.put(message)
+            self._prompts[prompt_id] = q
+        return q
+
+    def unregister(self, prompt_id: str):
+        with self._lock:
+            self._prompts.pop(prompt_id, None)
+            self._orphans.pop(prompt_id, None)
+
+    def run(self):
+        delay = WS_RECONNECT_DELAY_MIN
+        while True:
+            ws = websocket.WebSocket()
+            try:
+                ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+                self.connect_count += 1
+                self._connected.set()
+                logging.debug(
+                    f"[comfyui]ws connect done, client_id: {self.client_id}, server: {self.server_address}"
+                )
+                if self.connect_count > 1:
+                    self._notify_all({"type": WS_MSG_RECONNECTED, "data": {}})
+                delay = WS_RECONNECT_DELAY_MIN
+                while True:
+                    out = ws.recv()
+                    if not isinstance(out, str):
+                        self._route_binary(out)
+                        continue
+                    self._route(json.loads(out))
+            except Exception as err:
+                logging.warning(
+                    f"[comfyui]ws disconnected, client_id: {self.client_id}, err: {err}, reconnect in {delay}s"
+                )
+            finally:
+                self._connected.clear()
+                ws.close()
+            time.sleep(delay)
+            delay = min(delay * 2, WS_RECONNECT_DELAY_MAX)
+
+    def _route(self, message: dict):
+        data = message.get("data")
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        if prompt_id is None:
+            # status / crystools.monitor ...
+            return
+        with self._lock:
+            self._track_running(message["type"], data, prompt_id)
+            q = self._prompts.get(prompt_id)
+            if q:
+                q.put(message)
+                return
+            self._orphans.setdefault(prompt_id, []).append(message)
+            self._orphans.move_to_end(prompt_id)
+            while len(self._orphans) > WS_ORPHAN_PROMPTS_MAX:
+                self._orphans.popitem(last=False)
+
+    def _track_running(self, message_type: str, data: dict, prompt_id: str):
+        if message_type == "execution_start":
+            self._running_prompt_id = prompt_id
+        elif message_type in ("execution_error", "execution_interrupted") or (
+            message_type == "executing" and data.get("node") is None
+        ):
+            if self._running_prompt_id == prompt_id:
+                self._running_prompt_id = None
+
+    def _route_binary(self, out: bytes):
+        if len(out) <= 8:
+            return
+        event, image_type = struct.unpack(">II", out[:8])
+        if event != WS_BINARY_EVENT_PREVIEW_IMAGE:
+            return
+        with self._lock:
+            q = self._prompts.get(self._running_prompt_id)
+            if not q:
+                return
+            q.put(
+                {
+                    "type": WS_MSG_PREVIEW,
+                    "data": {
+                        "prompt_id": self._running_prompt_id,
+                        "image_type": WS_PREVIEW_IMAGE_TYPES.get(image_type),
+                        "image": out[8:],
+                    },
+                }
+            )
+
+    def _notify_all(self, message: dict):
+        with self._lock:
+            for q in self._prompts.values():
+                q.put(message)
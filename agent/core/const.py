@@ -20,6 +20,8 @@ TASK_STOPPED = "stopped"
 
 # Event Type
 EVENT_TYPE_WS = "ws"
+# (key, WSEvent), only the latest pending event of the same key is sent
+EVENT_TYPE_WS_LATEST = "ws_latest"
 EVENT_TYPE_INTERNAL_COMFYUI = "internal_comfyui"
 
 # Workers
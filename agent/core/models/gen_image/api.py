@@ -1,4 +1,4 @@
-from typing import Dict, List, Union, Any, Optional
+from typing import Dict, List, Union, Any, Optional, Tuple
 from pydantic import BaseModel, validator, Field
 from datetime import datetime
 
@@ -33,12 +33,69 @@ class Txt2imgRequest(BaseModel):
     batch_size: Optional[int] = 4
     width: Optional[int] = 1024
     height: Optional[int] = 1024
+    # task_tags["batch_index"] with seed renders the images of an earlier
+    # task which got them from the middle of a shared latent batch
     task_tags: Optional[dict] = {}
+    # interactive, batch or background, task_tags["priority"] if empty
+    priority: Optional[str] = None
+
+
+class TaskPosition(BaseModel):
+    priority: Optional[str] = None
+    # 0 if running
+    position: int
+    ahead: int
+    expected_wait_seconds: float
+    # unix seconds
+    predicted_finish_at: Optional[float] = None
 
 
 class Txt2imgResponse(CommonResponse):
     class Data(BaseModel):
         id: int
+        queue: Optional[TaskPosition] = None
+
+    data: Optional[Data] = None
+    # rejected by admission control, also in the Retry-After header
+    retry_after_seconds: Optional[int] = None
+
+
+class CancelTaskRequest(BaseModel):
+    id: int
+
+
+class GetTaskPositionRequest(BaseModel):
+    id: int
+
+
+class GetTaskPositionResponse(CommonResponse):
+    data: Optional[TaskPosition] = None
+
+
+class GetTaskTimingsRequest(BaseModel):
+    # spans of tasks done in the last window_seconds
+    window_seconds: Optional[int] = 3600
+    # spans of one task instead, window_seconds is ignored
+    id: Optional[int] = None
+
+
+class SpanPercentiles(BaseModel):
+    count: int
+    avg: float
+    p50: float
+    p90: float
+    p99: float
+    max: float
+
+
+class GetTaskTimingsResponse(CommonResponse):
+    class Data(BaseModel):
+        window_seconds: Optional[int] = None
+        # span name -> seconds, queue_wait, translate, submit, comfyui_queue,
+        # execute, node:<class_type>, download, db_commit
+        spans: Dict[str, SpanPercentiles] = {}
+        # of the task asked by id, in order
+        task_spans: Optional[List[Tuple[str, float]]] = None
 
     data: Optional[Data] = None
 
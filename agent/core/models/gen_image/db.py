@@ -1,5 +1,5 @@
 from typing import List
-from typing import Dict, List, Union, Any, Optional
+from typing import Dict, List, Union, Any, Optional, Tuple
 import logging
 from sqlalchemy import (
     UniqueConstraint,
@@ -12,6 +12,7 @@ from sqlalchemy import (
     Boolean,
     Float,
     JSON,
+    func,
 )
 from sqlalchemy.orm import mapped_column, Mapped, relationship, joinedload, aliased
 from sqlalchemy.dialects.sqlite import TEXT
@@ -111,6 +112,24 @@ class GenImageTaskDB(Base):
 
     # One-to-many relationship
     result_images = relationship("SDImageDB", back_populates="gen_image_task")
+    spans = relationship("GenImageTaskSpanDB", back_populates="gen_image_task")
+
+
+class GenImageTaskSpanDB(Base):
+    """
+    seconds a task spent in one stage, see GenImageWorker
+    """
+
+    __tablename__ = "gen_image_task_span"
+
+    name: Mapped[String] = mapped_column(String(256), default="", index=True)
+    seconds: Mapped[Float] = mapped_column(Float, default=0.0)
+    # comfyui prompt the task ran in, shared by coalesced tasks
+    prompt_id: Mapped[String] = mapped_column(String(64), nullable=True)
+
+    # Many-to-one relationship
+    gen_image_task_id = Column(Integer, ForeignKey("gen_image_task.id"), index=True)
+    gen_image_task = relationship("GenImageTaskDB", back_populates="spans")
 
 
 def add_gen_image_task_db(
@@ -161,6 +180,17 @@ def get_gen_image_task_db(task_id: int) -> GenImageTask:
         return GenImageTask.model_validate(gen_image_task)
 
 
+def find_gen_image_task_db(task_id: int) -> Optional[GenImageTask]:
+    with get_session() as s:
+        gen_image_task = (
+            s.query(GenImageTaskDB).filter(GenImageTaskDB.id == task_id).first()
+        )
+        if gen_image_task:
+            return GenImageTask.model_validate(gen_image_task)
+        else:
+            return None
+
+
 def update_gen_image_task_status(task_id: int, task_status: str, err_msg: str = None):
     with get_session() as s:
         gen_image_task = (
@@ -172,6 +202,139 @@ def update_gen_image_task_status(task_id: int, task_status: str, err_msg: str =
         s.commit()
 
 
+def update_gen_image_task_preempted(task_id: int, seed: int, batch_index: int):
+    """
+    back to pending, the seed and batch_index it ran with are kept so it
+    renders the same
+    """
+    with get_session() as s:
+        gen_image_task = (
+            s.query(GenImageTaskDB).filter(GenImageTaskDB.id == task_id).one()
+        )
+        gen_image_task.task_status = TASK_PENDING
+        gen_image_task.seed = seed
+        gen_image_task.task_tags = _with_batch_index(
+            gen_image_task.task_tags, batch_index
+        )
+        s.commit()
+
+
+def update_gen_image_task_batch_index(task_id: int, batch_index: int):
+    with get_session() as s:
+        gen_image_task = (
+            s.query(GenImageTaskDB).filter(GenImageTaskDB.id == task_id).one()
+        )
+        gen_image_task.task_tags = _with_batch_index(
+            gen_image_task.task_tags, batch_index
+        )
+        s.commit()
+
+
+def _with_batch_index(task_tags, batch_index: int) -> dict:
+    # a new dict, sqlalchemy does not see changes inside a JSON value
+    task_tags = dict(task_tags) if isinstance(task_tags, dict) else {}
+    task_tags["batch_index"] = batch_index
+    return task_tags
+
+
+def add_gen_image_task_spans_db(
+    task_id: int, spans: List[Tuple[str, float]], prompt_id: str = None
+):
+    with get_session() as s:
+        s.add_all(
+            [
+                GenImageTaskSpanDB(
+                    name=name,
+                    seconds=seconds,
+                    prompt_id=prompt_id,
+                    gen_image_task_id=task_id,
+                )
+                for name, seconds in spans
+            ]
+        )
+        s.commit()
+
+
+def get_gen_image_task_spans_db(task_id: int) -> List[Tuple[str, float]]:
+    with get_session() as s:
+        spans = (
+            s.query(GenImageTaskSpanDB)
+            .filter(GenImageTaskSpanDB.gen_image_task_id == task_id)
+            .order_by(GenImageTaskSpanDB.id)
+            .all()
+        )
+        return [(span.name, span.seconds) for span in spans]
+
+
+def get_gen_image_task_span_seconds_db(window_seconds: int) -> Dict[str, List[float]]:
+    """
+    return: span name -> seconds of the spans of the last window_seconds
+    """
+    with get_session() as s:
+        rows = (
+            s.query(GenImageTaskSpanDB.name, GenImageTaskSpanDB.seconds)
+            .filter(
+                # created_at is written by sqlite, compare in its format
+                GenImageTaskSpanDB.created_at
+                >= func.datetime("now", f"-{int(window_seconds)} seconds")
+            )
+            .all()
+        )
+        seconds_by_name = {}
+        for name, seconds in rows:
+            seconds_by_name.setdefault(name, []).append(seconds)
+        return seconds_by_name
+
+
+def get_gen_image_task_span_tasks_db(name: str, limit: int) -> List[tuple]:
+    """
+    return: (prompt_id, seconds, ckpt_name, sampler_name, steps, batch_size,
+    width, height) of the last limit spans named name, oldest first, the
+    prompt_id of a span without one is f"span_{id}"
+    """
+    with get_session() as s:
+        rows = (
+            s.query(
+                GenImageTaskSpanDB.id,
+                GenImageTaskSpanDB.prompt_id,
+                GenImageTaskSpanDB.seconds,
+                GenImageTaskDB.ckpt_name,
+                GenImageTaskDB.sampler_name,
+                GenImageTaskDB.steps,
+                GenImageTaskDB.batch_size,
+                GenImageTaskDB.width,
+                GenImageTaskDB.height,
+            )
+            .join(
+                GenImageTaskDB,
+                GenImageTaskSpanDB.gen_image_task_id == GenImageTaskDB.id,
+            )
+            .filter(GenImageTaskSpanDB.name == name)
+            .order_by(GenImageTaskSpanDB.id.desc())
+            .limit(limit)
+            .all()
+        )
+        return [
+            (prompt_id or f"span_{span_id}", *row)
+            for span_id, prompt_id, *row in reversed(rows)
+        ]
+
+
+def get_gen_image_task_last_span_seconds_db(name: str, limit: int) -> List[float]:
+    """
+    return: seconds of the last limit spans named name, oldest first
+    """
+    with get_session() as s:
+        rows = (
+            s.query(GenImageTaskSpanDB.seconds)
+            .filter(GenImageTaskSpanDB.name == name)
+            .order_by(GenImageTaskSpanDB.id.desc())
+            .limit(limit)
+            .all()
+        )
+        return [seconds for (seconds,) in reversed(rows)]
+
+
 def get_gen_image_task_list_db(
     page: int, page_size: int, status: str = None
 ) -> tuple[List[GenImageTask], int]:
@@ -243,6 +406,57 @@ def add_sd_images_db(
         s.commit()
 
 
+def find_sd_images_by_params_db(
+    prompt: str,
+    negative_prompt: str,
+    width: int,
+    height: int,
+    seed: int,
+    steps: int,
+    cfg: float,
+    sampler_name: str,
+    scheduler: str,
+    denoise: float,
+    ckpt_name: str,
+    batch_size: int,
+) -> List[SDImage]:
+    """
+    images of the latest done task with a fixed seed and the same params,
+    empty if none has all of its images left
+    """
+    with get_session() as s:
+        q = s.query(SDImageDB).join(
+            GenImageTaskDB, SDImageDB.gen_image_task_id == GenImageTaskDB.id
+        )
+        q = q.filter(
+            GenImageTaskDB.task_status == TASK_DONE,
+            GenImageTaskDB.seed != 0,
+            SDImageDB.prompt == prompt,
+            SDImageDB.negative_prompt == negative_prompt,
+            SDImageDB.width == width,
+            SDImageDB.height == height,
+            SDImageDB.seed == seed,
+            SDImageDB.steps == steps,
+            SDImageDB.cfg == cfg,
+            SDImageDB.sampler_name == sampler_name,
+            SDImageDB.scheduler == scheduler,
+            SDImageDB.denoise == denoise,
+            SDImageDB.ckpt_name == ckpt_name,
+        )
+        q = q.order_by(SDImageDB.gen_image_task_id.desc(), SDImageDB.id)
+        sd_images = q.limit(batch_size * 8).all()
+
+        tasks = {}
+        for sd_image in sd_images:
+            tasks.setdefault(sd_image.gen_image_task_id, []).append(sd_image)
+        for task_images in tasks.values():
+            if len(task_images) == batch_size and not any(
+                sd_image.image_file_deleted for sd_image in task_images
+            ):
+                return [SDImage.model_validate(sd_image) for sd_image in task_images]
+        return []
+
+
 def get_sd_image_list_db(
     page: int,
     page_size: int,
@@ -77,6 +77,10 @@ class GenImageTask(BaseModel):
 
     result_images: Optional[List[SDImage]] = None
 
+    # eta of queued or running tasks, unix seconds
+    predicted_finish_at: Optional[float] = None
+    queue_wait_seconds: Optional[float] = None
+
     class Config:
         from_attributes = True
 
@@ -84,3 +88,27 @@ class GenImageTask(BaseModel):
 class GenImageWorkerTask(BaseModel):
     task_id: int
     task_type: TaskType
+
+    # used by the queue to group tasks which load the same model, and to
+    # coalesce tasks which can run in one comfyui prompt
+    ckpt_name: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    steps: Optional[int] = None
+    cfg: Optional[float] = None
+    sampler_name: Optional[str] = None
+    scheduler: Optional[str] = None
+    denoise: Optional[float] = None
+    batch_size: Optional[int] = None
+    # tasks with the same prompts and a random seed share one latent batch
+    origin_prompt: Optional[str] = None
+    negative_prompt: Optional[str] = None
+    seed: Optional[int] = None
+
+    # fair queueing, see GenImageTaskQueue
+    priority: Optional[str] = None
+    submitter: Optional[str] = None
+    # times stopped for tasks of higher priority
+    preempted: int = 0
+    # unix seconds, set by GenImageTaskQueue.put
+    enqueued_at: Optional[float] = None
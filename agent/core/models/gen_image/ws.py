@@ -9,6 +9,10 @@ from core.models.common import *
 TOPIC_GENIMAGE_PROGRESS = "genimage_progress"
 TOPIC_GENIMAGE_END = "genimage_end"
 TOPIC_GENIMAGE_FAILED = "genimage_failed"
+TOPIC_GENIMAGE_PREVIEW = "genimage_preview"
+TOPIC_GENIMAGE_CANCELED = "genimage_canceled"
+# stopped for a task of higher priority and queued again
+TOPIC_GENIMAGE_PREEMPTED = "genimage_preempted"
 
 
 class GenImageEvent(WSEvent):
@@ -21,6 +25,13 @@ class GenImageEvent(WSEvent):
         progress_value: Optional[int] = None
         progress_value_max: Optional[int] = None
 
+        # preview, jpeg data url
+        preview: Optional[str] = None
+
+        # eta, unix seconds
+        predicted_finish_at: Optional[float] = None
+        queue_wait_seconds: Optional[float] = None
+
         # result
         images: Optional[List[str]] = None
         err_msg: Optional[str] = None
@@ -0,0 +1,49 @@
+from typing import List, Optional, Tuple
+from sqlalchemy import String
+from sqlalchemy.orm import mapped_column, Mapped
+from sqlalchemy.dialects.sqlite import TEXT
+
+from core.db.common import Base
+from core.db.db import get_session
+
+
+class TranslationDB(Base):
+    __tablename__ = "translation"
+
+    # sha256 of the normalized source text
+    key: Mapped[String] = mapped_column(String(64), unique=True, index=True)
+    text: Mapped[TEXT] = mapped_column(TEXT, default="")
+    translation: Mapped[TEXT] = mapped_column(TEXT, default="")
+
+
+def find_translation_db(key: str) -> Optional[str]:
+    with get_session() as s:
+        translation = s.query(TranslationDB).filter(TranslationDB.key == key).first()
+        return translation.translation if translation else None
+
+
+def add_translation_db(key: str, text: str, translation: str):
+    with get_session() as s:
+        if s.query(TranslationDB).filter(TranslationDB.key == key).first():
+            return
+        s.add(TranslationDB(key=key, text=text, translation=translation))
+        s.commit()
+
+
+def add_translations_db(translations: List[Tuple[str, str, str]]) -> int:
+    """
+    translations: (key, text, translation), existing keys are skipped
+
+    return: rows added
+    """
+    with get_session() as s:
+        keys = {key for (key,) in s.query(TranslationDB.key).all()}
+        added = 0
+        for key, text, translation in translations:
+            if key in keys:
+                continue
+            keys.add(key)
+            s.add(TranslationDB(key=key, text=text, translation=translation))
+            added += 1
+        s.commit()
+        return added
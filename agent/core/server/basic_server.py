@@ -3,6 +3,7 @@ from fastapi import (
     Depends,
     FastAPI,
     HTTPException,
+    Request,
 )
 from fastapi.exceptions import RequestValidationError
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
@@ -34,6 +35,8 @@ class BasicServer:
 
         self.loop = loop
         self.ws_event_queue: asyncio.Queue = asyncio.Queue()
+        # key -> latest WSEvent, the key is queued once until sent
+        self.ws_latest_events = dict()
         self.workers = dict()
 
         # init app api
@@ -63,6 +66,9 @@ class BasicServer:
         dispatcher = EventDispatcher()
         threading.Thread(target=dispatcher.start_dispatching, daemon=True).start()
         dispatcher.add_event_listener(EVENT_TYPE_WS, self.ws_send_event_sync)
+        dispatcher.add_event_listener(
+            EVENT_TYPE_WS_LATEST, self.ws_send_latest_event_sync
+        )
 
     async def run(self):
         host = ConfigMgr().get_conf("server")["host"]
@@ -82,9 +88,21 @@ class BasicServer:
         # 在 asyncio 中，所有的事件循环操作都应该在同一个线程中完成，以确保线程安全性。但有时候，我们可能需要在不同的线程中调用事件循环。这时就可以使用 call_soon_threadsafe 来安全地将回调函数放入事件循环的队列中，以便稍后在事件循环中执行。
         self.loop.call_soon_threadsafe(self.ws_event_queue.put_nowait, event)
 
+    def ws_send_latest_event_sync(self, keyed_event: tuple[str, WSEvent]):
+        self.loop.call_soon_threadsafe(self._put_latest_event, *keyed_event)
+
+    def _put_latest_event(self, key: str, event: WSEvent):
+        # slow client: stale events are replaced while waiting in queue
+        pending = key in self.ws_latest_events
+        self.ws_latest_events[key] = event
+        if not pending:
+            self.ws_event_queue.put_nowait(key)
+
     async def _ws_event_loop(self):
         while True:
-            event: WSEvent = await self.ws_event_queue.get()
+            event = await self.ws_event_queue.get()
+            if isinstance(event, str):
+                event = self.ws_latest_events.pop(event)
             await self._ws_send_event(event)
 
     async def _ws_send_event(self, event: WSEvent):
@@ -109,11 +127,17 @@ class BasicServer:
             path, endpoint, response_model_exclude_none=True, **kwargs
         )
 
-    def auth(self, credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+    def auth(
+        self,
+        request: Request,
+        credentials: HTTPBasicCredentials = Depends(HTTPBasic()),
+    ):
         if credentials.username in self.credentials:
             if compare_digest(
                 credentials.password, self.credentials[credentials.username]
             ):
+                # submitter of tasks, see GenImageTaskQueue
+                request.state.username = credentials.username
                 return True
         raise HTTPException(
             status_code=401,
@@ -6,6 +6,7 @@ from fastapi import (
     WebSocket,
     WebSocketDisconnect,
     Request,
+    Response,
 )
 import json
 import random
@@ -21,8 +22,25 @@ from core.models.config import *
 from core.models.gen_image.object import *
 from core.models.gen_image.db import *
 from core.models.gen_image.api import *
-from core.workers.gen_image_worker import GenImageWorker, GenImageTask
+from core.workers.gen_image_worker import (
+    CANCEL_NOT_FOUND,
+    CANCEL_STOP_FAILED,
+    GenImageWorkerPool,
+    GenImageTask,
+)
+from core.workers.task_queue import PRIORITIES, resolve_priority
 from core.storage.storage_mgr import StorageMgr
+from core.storage.result_cache import ResultCache
+from core.storage.translation_cache import TranslationCache
+from core.utils.translator import Translator
+from core.comfyui.backend_pool import BackendPool
+from core.comfyui.transport import HttpTransport
+from core.comfyui.preview import PreviewForwarder
+from core.comfyui.object_info import ObjectInfoCatalog
+from core.comfyui.upload_cache import UploadCache
+from core.comfyui.workflows import basic_txt2img
+from core.comfyui.workflows.registry import WorkflowRegistry
+from core.utils.utils import percentile
 
 from .basic_server import BasicServer
 from .exception_handlers import *
@@ -46,6 +64,21 @@ class Server(BasicServer):
         # 获取任务列表
         self.add_api_route("/api/image/tasks", self.api_image_tasks, methods=["POST"])
 
+        # 取消任务
+        self.add_api_route(
+            "/api/image/task/cancel", self.api_cancel_task, methods=["POST"]
+        )
+
+        # 获取任务排队位置
+        self.add_api_route(
+            "/api/image/task/position", self.api_get_task_position, methods=["POST"]
+        )
+
+        # 获取任务耗时分布
+        self.add_api_route(
+            "/api/image/task/timings", self.api_get_task_timings, methods=["POST"]
+        )
+
         # 文生图、调整-重新生成
         self.add_api_route("/api/image/txt2img", self.api_txt2img, methods=["POST"])
         # 变化
@@ -119,6 +152,9 @@ class Server(BasicServer):
         # 更新配置
         self.add_api_route("/api/config", self.api_update_config, methods=["PUT"])
 
+        # 获取运行指标
+        self.add_api_route("/api/metrics", self.api_get_metrics, methods=["GET"])
+
         logging.info("server init done")
 
     async def ws(self, websocket: WebSocket):
@@ -162,17 +198,137 @@ class Server(BasicServer):
         list, total = get_gen_image_task_list_db(
             page=request.page, page_size=request.page_size
         )
+        gen_image_worker_pool: GenImageWorkerPool = self.workers[WORKER_GEN_IMAGE]
+        for task in list:
+            if task.task_status not in [TASK_DOING, TASK_PENDING]:
+                continue
+            position = gen_image_worker_pool.position(task.id)
+            if position:
+                task.queue_wait_seconds = position["expected_wait_seconds"]
+                task.predicted_finish_at = position["predicted_finish_at"]
         return GetImageTasksResponse(
             data=GetImageTasksResponse.Data(
                 page=request.page, page_size=request.page_size, total=total, list=list
             )
         )
 
+    # 取消任务
+    def api_cancel_task(self, request: CancelTaskRequest):
+        gen_image_task = find_gen_image_task_db(request.id)
+        if not gen_image_task:
+            return CommonResponse(code=ERR_CODE_NOT_FOUND, msg="任务不存在")
+        if gen_image_task.task_status not in [TASK_DOING, TASK_PENDING]:
+            return CommonResponse(
+                code=ERR_CODE_INVALID_PARAM,
+                msg=f"任务已结束: {gen_image_task.task_status}",
+            )
+        gen_image_worker_pool: GenImageWorkerPool = self.workers[WORKER_GEN_IMAGE]
+        result = gen_image_worker_pool.cancel_task(request.id)
+        if result == CANCEL_NOT_FOUND:
+            return CommonResponse(code=ERR_CODE_INVALID_PARAM, msg="任务不在队列中")
+        if result == CANCEL_STOP_FAILED:
+            return CommonResponse(
+                code=ERR_CODE_INTERNAL_ERROR, msg="任务已取消, 绘图引擎停止失败"
+            )
+        return CommonResponse(data="cancel done")
+
+    # 获取任务排队位置
+    def api_get_task_position(
+        self, request: GetTaskPositionRequest
+    ) -> GetTaskPositionResponse:
+        gen_image_worker_pool: GenImageWorkerPool = self.workers[WORKER_GEN_IMAGE]
+        position = gen_image_worker_pool.position(request.id)
+        if not position:
+            return GetTaskPositionResponse(
+                code=ERR_CODE_NOT_FOUND, msg="任务不在队列中"
+            )
+        return GetTaskPositionResponse(data=TaskPosition(**position))
+
+    # 获取任务耗时分布
+    def api_get_task_timings(
+        self, request: GetTaskTimingsRequest
+    ) -> GetTaskTimingsResponse:
+        if request.id is not None:
+            return GetTaskTimingsResponse(
+                data=GetTaskTimingsResponse.Data(
+                    task_spans=get_gen_image_task_spans_db(request.id)
+                )
+            )
+        spans = {}
+        for name, seconds in get_gen_image_task_span_seconds_db(
+            request.window_seconds
+        ).items():
+            seconds.sort()
+            spans[name] = SpanPercentiles(
+                count=len(seconds),
+                avg=round(sum(seconds) / len(seconds), 3),
+                p50=round(percentile(seconds, 50), 3),
+                p90=round(percentile(seconds, 90), 3),
+                p99=round(percentile(seconds, 99), 3),
+                max=round(seconds[-1], 3),
+            )
+        return GetTaskTimingsResponse(
+            data=GetTaskTimingsResponse.Data(
+                window_seconds=request.window_seconds, spans=spans
+            )
+        )
+
     # 文生图、调整-重新生成
-    def api_txt2img(self, request: Txt2imgRequest) -> Txt2imgResponse:
+    def api_txt2img(
+        self, request: Txt2imgRequest, http_request: Request, http_response: Response
+    ) -> Txt2imgResponse:
 
         logging.debug(f"api_txt2img request: {request.model_dump_json()}")
 
+        priority = resolve_priority(request.priority, request.task_tags)
+        if priority not in PRIORITIES:
+            return Txt2imgResponse(
+                code=ERR_CODE_INVALID_PARAM, msg=f"priority not support: {priority}"
+            )
+        # api user, else whoever the tags name, else the client address
+        submitter = getattr(http_request.state, "username", None)
+        if not submitter and request.task_tags:
+            submitter = request.task_tags.get("submitter")
+        if not submitter and http_request.client:
+            submitter = http_request.client.host
+
+        # reject bad params before they take a queue slot
+        err_msg = basic_txt2img.validate(
+            ckpt_name=request.ckpt_name,
+            sampler_name=request.sampler_name,
+            scheduler=request.scheduler,
+        )
+        if err_msg:
+            return Txt2imgResponse(code=ERR_CODE_INVALID_PARAM, msg=err_msg)
+
+        # task_id is known after the db write
+        new_task = GenImageWorkerTask(
+            task_id=0,
+            task_type=TaskType.TXT2IMG,
+            ckpt_name=request.ckpt_name,
+            width=request.width,
+            height=request.height,
+            steps=request.steps,
+            cfg=request.cfg,
+            sampler_name=request.sampler_name,
+            scheduler=request.scheduler,
+            denoise=request.denoise,
+            batch_size=request.batch_size,
+            origin_prompt=request.origin_prompt,
+            negative_prompt=request.negative_prompt,
+            seed=request.seed,
+            priority=priority,
+            submitter=submitter,
+        )
+
+        # reject fast instead of queueing for hours
+        gen_image_worker_pool: GenImageWorkerPool = self.workers[WORKER_GEN_IMAGE]
+        rejected = gen_image_worker_pool.admit(new_task)
+        if rejected:
+            code, msg, retry_after = rejected
+            http_response.headers["Retry-After"] = str(retry_after)
+            return Txt2imgResponse(code=code, msg=msg, retry_after_seconds=retry_after)
+
         # add task to db
         task_id = add_gen_image_task_db(
             task_type=TaskType.TXT2IMG.value,
@@ -193,13 +349,22 @@ class Server(BasicServer):
         logging.debug(f"new txt2img task, add to db done, id: {task_id}")
 
         # add task to work
-        gen_image_worker: GenImageWorker = self.workers[WORKER_GEN_IMAGE]
-        gen_image_worker.add_task(
-            GenImageWorkerTask(task_id=task_id, task_type=TaskType.TXT2IMG)
+        new_task.task_id = task_id
+        gen_image_worker_pool.add_task(new_task)
+
+        # load the translation model while the task is queued
+        if Translator.detect_language(
+            request.origin_prompt
+        ) == "zh-cn" and not TranslationCache().contains(request.origin_prompt):
+            Translator().preload()
+
+        position = gen_image_worker_pool.position(task_id)
+        return Txt2imgResponse(
+            data=Txt2imgResponse.Data(
+                id=task_id, queue=TaskPosition(**position) if position else None
+            )
         )
 
-        return Txt2imgResponse(data=Txt2imgResponse.Data(id=task_id))
-
     # 变化
     def api_img2img(self):
         pass
@@ -309,3 +474,21 @@ class Server(BasicServer):
 
     def api_update_config(self, request: UpdateConfigRequest):
         return CommonResponse(data="done")
+
+    def api_get_metrics(self):
+        gen_image_worker_pool: GenImageWorkerPool = self.workers[WORKER_GEN_IMAGE]
+        return CommonResponse(
+            data={
+                "gen_image_queue": gen_image_worker_pool.task_queue.metrics(),
+                "gen_image_workers": gen_image_worker_pool.metrics(),
+                "comfyui_backends": BackendPool().metrics(),
+                "comfyui_transport": HttpTransport().metrics(),
+                "comfyui_preview": PreviewForwarder().metrics(),
+                "comfyui_object_info": ObjectInfoCatalog().metrics(),
+                "comfyui_upload_cache": UploadCache().metrics(),
+                "comfyui_workflows": WorkflowRegistry().metrics(),
+                "result_cache": ResultCache().metrics(),
+                "translation_cache": TranslationCache().metrics(),
+                "translator": Translator().metrics(),
+            }
+        )
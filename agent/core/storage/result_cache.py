@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+from core.config import ConfigMgr
+from core.models.gen_image.db import find_sd_images_by_params_db
+from core.storage.storage_mgr import StorageMgr
+
+DEFAULT_RESULT_CACHE_MAX_LEN = 1024
+
+
+class ResultCache:
+    """
+    images of txt2img tasks with a fixed seed, same params give the same
+    images so a repeat is served from disk without comfyui
+
+    LRU of params hash -> image filenames in output_file_dir, a miss falls
+    back to the sd_image table
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        storage_conf = ConfigMgr().get_conf("storage")
+        self.enable = storage_conf.get("result_cache_enable", True)
+        self.max_len = storage_conf.get(
+            "result_cache_max_len", DEFAULT_RESULT_CACHE_MAX_LEN
+        )
+        self._mutex = threading.Lock()
+        self._lru: OrderedDict[str, List[str]] = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(params: dict) -> str:
+        canonical = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, params: dict) -> Optional[List[str]]:
+        """
+        params: kwargs of find_sd_images_by_params_db
+
+        return: filenames of new copies of the cached images, None on miss
+        """
+        if not self.enable:
+            return None
+        key = self.key(params)
+        with self._mutex:
+            image_filenames = self._lru.get(key)
+            if image_filenames:
+                self._lru.move_to_end(key)
+        from_db = False
+        if not image_filenames or not self._exists(image_filenames):
+            sd_images = find_sd_images_by_params_db(**params)
+            if len(sd_images) == 0:
+                self._count("misses")
+                return None
+            image_filenames = [f"{img.uuid}.{img.format}" for img in sd_images]
+            from_db = True
+        try:
+            copies = self._copy(image_filenames)
+        except OSError as err:
+            # deleted meanwhile
+            logging.warning(f"result cache copy failed: {err}")
+            self._count("misses")
+            return None
+        self.put(params, image_filenames)
+        self._count("db_hits" if from_db else "hits")
+        return copies
+
+    def put(self, params: dict, image_filenames: List[str]):
+        if not self.enable:
+            return
+        key = self.key(params)
+        with self._mutex:
+            self._lru[key] = image_filenames
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_len:
+                self._lru.popitem(last=False)
+                self.evictions += 1
+
+    def _exists(self, image_filenames: List[str]) -> bool:
+        output_dir = StorageMgr().output_file_dir
+        return all(os.path.exists(f"{output_dir}/{f}") for f in image_filenames)
+
+    def _copy(self, image_filenames: List[str]) -> List[str]:
+        # every sd_image owns its file, deleting one must not affect the other
+        output_dir = StorageMgr().output_file_dir
+        copies = []
+        try:
+            for image_filename in image_filenames:
+                copy_filename = f"{uuid.uuid4()}{os.path.splitext(image_filename)[1]}"
+                src = f"{output_dir}/{image_filename}"
+                dst = f"{output_dir}/{copy_filename}"
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copyfile(src, dst)
+                copies.append(copy_filename)
+        except OSError as err:
+            for copy_filename in copies:
+                os.remove(f"{output_dir}/{copy_filename}")
+            raise err
+        return copies
+
+    def _count(self, name: str):
+        with self._mutex:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def metrics(self) -> dict:
+        with self._mutex:
+            return {
+                "size": len(self._lru),
+                "hits": self.hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from core.config import ConfigMgr
+from core.models.translation.db import (
+    add_translation_db,
+    add_translations_db,
+    find_translation_db,
+)
+
+DEFAULT_TRANSLATION_CACHE_MAX_LEN = 4096
+DEFAULT_TRANSLATION_CACHE_SEED_FILE = "resource/prompt_example.json"
+
+
+class TranslationCache:
+    """
+    zh -> en translations by normalized text, so a repeated prompt does not
+    load or run the translation model
+
+    LRU in memory, a miss falls back to the translation table, which is
+    seeded with the pairs of prompt_example.json
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        translator_conf = ConfigMgr().get_conf("translator")
+        self.enable = translator_conf.get("cache_enable", True)
+        self.max_len = translator_conf.get(
+            "cache_max_len", DEFAULT_TRANSLATION_CACHE_MAX_LEN
+        )
+        self._mutex = threading.Lock()
+        self._lru: OrderedDict[str, str] = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.seeded = 0
+        if self.enable:
+            self._seed(
+                translator_conf.get(
+                    "cache_seed_file", DEFAULT_TRANSLATION_CACHE_SEED_FILE
+                )
+            )
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # full width punctuation and runs of spaces do not change the meaning
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+    @staticmethod
+    def key(text: str) -> str:
+        normalized = TranslationCache.normalize(text)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[str]:
+        if not self.enable:
+            return None
+        key = self.key(text)
+        with self._mutex:
+            translation = self._lru.get(key)
+            if translation is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return translation
+        try:
+            translation = find_translation_db(key)
+        except Exception as err:
+            logging.warning(f"translation cache db err: {err}")
+            translation = None
+        if translation is None:
+            self._count("misses")
+            return None
+        self._put_lru(key, translation)
+        self._count("db_hits")
+        return translation
+
+    def contains(self, text: str) -> bool:
+        """
+        like get, without counting a lookup
+        """
+        if not self.enable:
+            return False
+        key = self.key(text)
+        with self._mutex:
+            if key in self._lru:
+                return True
+        try:
+            return find_translation_db(key) is not None
+        except Exception as err:
+            logging.warning(f"translation cache db err: {err}")
+            return False
+
+    def put(self, text: str, translation: str):
+        if not self.enable:
+            return
+        key = self.key(text)
+        self._put_lru(key, translation)
+        try:
+            add_translation_db(key, self.normalize(text), translation)
+        except Exception as err:
+            logging.warning(f"translation cache db err: {err}")
+
+    def _put_lru(self, key: str, translation: str):
+        with self._mutex:
+            self._lru[key] = translation
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_len:
+                self._lru.popitem(last=False)
+                self.evictions += 1
+
+    def _seed(self, seed_file: str):
+        try:
+            with open(seed_file, "r", encoding="utf-8") as f:
+                examples = json.load(f)
+            self.seeded = add_translations_db(
+                [
+                    (
+                        self.key(example["zh-cn"]),
+                        self.normalize(example["zh-cn"]),
+                        example["en"],
+                    )
+                    for example in examples
+                    if example.get("zh-cn") and example.get("en")
+                ]
+            )
+        except Exception as err:
+            logging.warning(f"translation cache seed from {seed_file} err: {err}")
+            return
+        logging.info(
+            f"translation cache seeded {self.seeded} translations from {seed_file}"
+        )
+
+    def _count(self, name: str):
+        with self._mutex:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def metrics(self) -> dict:
+        with self._mutex:
+            lookups = self.hits + self.db_hits + self.misses
+            return {
+                "size": len(self._lru),
+                "hits": self.hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    round((self.hits + self.db_hits) / lookups, 3) if lookups else 0
+                ),
+                "evictions": self.evictions,
+                "seeded": self.seeded,
+            }
@@ -1,38 +1,96 @@
 import threading
+from concurrent.futures import Future
+from typing import List, Optional
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 import torch
 import gc
+import os
 import time
 import logging
 
 from core.config import ConfigMgr
+from core.storage.translation_cache import TranslationCache
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+# requests arriving this long after the first one share its generate call
+DEFAULT_BATCH_WINDOW_MS = 5
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_UNLOAD_MODEL_SECONDS = 300
+# load the model at startup instead of on the first chinese prompt
+DEFAULT_PRELOAD = False
+UNLOAD_CHECK_SECONDS = 10
 
 
 class Translator:
+    """
+    zh -> en translation, cached texts are answered by TranslationCache,
+    concurrent requests for the others are gathered for batch_window_ms and
+    translated by one padded generate call
+
+    the model is loaded at startup with preload, else in background when a
+    chinese prompt is queued, and unloaded after unload_model_seconds
+    without translations, 0 keeps it loaded
+    """
 
     _instance = None
     _lock = threading.Lock()
+    # load, generate and unload
     _model_lock = threading.Lock()
 
     def __new__(cls):
         if not cls._instance:
             with cls._lock:
                 if not cls._instance:
-                    cls._instance = super().__new__(cls)
-                    cls._instance._init_instance()
+                    # publish only after init, workers translate concurrently
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
         return cls._instance
 
     def _init_instance(self):
         self.model = None
         self.tokenizer = None
 
-    def _unload_model(self):
-        with self._lock:
-            del self.model
-            del self.tokenizer
-            gc.collect()
-            self.model = None
-            self.tokenizer = None
+        translator_conf = ConfigMgr().get_conf("translator")
+        self.batch_window = (
+            translator_conf.get("batch_window_ms", DEFAULT_BATCH_WINDOW_MS) / 1000
+        )
+        self.max_batch_size = translator_conf.get(
+            "max_batch_size", DEFAULT_MAX_BATCH_SIZE
+        )
+        # (text, future)
+        self._pending = []
+        self._batch_cond = threading.Condition(threading.Lock())
+        self.batches = 0
+        self.translated = 0
+        # requests queued or being translated
+        self._inflight = 0
+
+        self.unload_seconds = translator_conf.get(
+            "unload_model_seconds", DEFAULT_UNLOAD_MODEL_SECONDS
+        )
+        self.loading = False
+        self.last_used_at = time.time()
+        self.loads = 0
+        self.unloads = 0
+        self.load_seconds = None
+        self.model_bytes = 0
+        self.rss_delta_on_load = None
+
+        threading.Thread(
+            target=self._batch_loop, name="TranslatorBatch", daemon=True
+        ).start()
+        if self.unload_seconds > 0:
+            threading.Thread(
+                target=self._unload_loop, name="TranslatorUnload", daemon=True
+            ).start()
+        if translator_conf.get("preload", DEFAULT_PRELOAD):
+            self.preload()
 
     @staticmethod
     def detect_language(input_str):
@@ -53,36 +111,212 @@ class Translator:
             return "unknow"
 
     def run(self, en_text: str):
-        if not en_text or len(en_text) == 0:
-            return ""
-        if Translator.detect_language(en_text) != "zh-cn":
-            return en_text
-        with self._lock:
-            start_t = time.time()
-            if not self.model:
-                debug = ConfigMgr().get_conf("translator")["debug"]
-                if debug:
-                    pretrained_model_name_or_path = "models/translation/opus-mt-zh-en"
+        return self.run_batch([en_text])[0]
+
+    def run_batch(self, texts: List[str]) -> List[str]:
+        """
+        translate texts in one go, texts not in chinese are returned as is
+        """
+        futures = []
+        pending = []
+        for text in texts:
+            future = Future()
+            if not text or len(text) == 0:
+                future.set_result("")
+            elif Translator.detect_language(text) != "zh-cn":
+                future.set_result(text)
+            else:
+                translation = TranslationCache().get(text)
+                if translation is not None:
+                    future.set_result(translation)
                 else:
-                    raise NotImplementedError()
-                self.model = AutoModelForSeq2SeqLM.from_pretrained(
-                    pretrained_model_name_or_path=pretrained_model_name_or_path,
-                    local_files_only=True,
-                )
-                device = ConfigMgr().get_conf("translator")["device"]
-                self.model.to(device)
-                self.tokenizer = AutoTokenizer.from_pretrained(
-                    pretrained_model_name_or_path=pretrained_model_name_or_path,
-                    local_files_only=True,
-                )
-                logging.debug(f"[Translator] model load cost {time.time()-start_t}s")
-
-                delay = ConfigMgr().get_conf("translator")["unload_model_seconds"]
-                threading.Timer(delay, self._unload_model)
+                    pending.append((text, future))
+            futures.append(future)
+        if len(pending) != 0:
+            with self._batch_cond:
+                self._pending.extend(pending)
+                self._inflight += len(pending)
+                self._batch_cond.notify()
+        return [future.result() for future in futures]
+
+    def _batch_loop(self):
+        while True:
+            with self._batch_cond:
+                while len(self._pending) == 0:
+                    self._batch_cond.wait()
+                # gather the requests of other tasks for a moment
+                deadline = time.time() + self.batch_window
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._batch_cond.wait(remaining)
+                batch = self._pending[: self.max_batch_size]
+                del self._pending[: self.max_batch_size]
+            # same prompt from several tasks is translated once
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                results = dict(zip(texts, self._translate(texts)))
+            except Exception as err:
+                logging.error(f"[Translator] translate err: {err}")
+                for _, future in batch:
+                    future.set_exception(err)
+                continue
+            finally:
+                with self._batch_cond:
+                    self._inflight -= len(batch)
+            self.batches += 1
+            self.translated += len(batch)
+            for text, future in batch:
+                future.set_result(results[text])
+            for text, translation in results.items():
+                TranslationCache().put(text, translation)
+
+    def _translate(self, texts: List[str]) -> List[str]:
+        # held while generating, so the model is not unloaded under it
+        with self._model_lock:
+            self._load_model()
+            start_t = time.time()
             with torch.no_grad():
-                encoded = self.tokenizer([en_text], return_tensors="pt", padding=True)
+                encoded = self.tokenizer(texts, return_tensors="pt", padding=True)
                 encoded.to(self.model.device)
                 sequences = self.model.generate(**encoded)
                 res = self.tokenizer.batch_decode(sequences, skip_special_tokens=True)
-                logging.debug(f"[Translator] trans cost {time.time()-start_t}s")
-                return res[0]
+            self.last_used_at = time.time()
+            logging.debug(
+                f"[Translator] trans {len(texts)} texts cost {time.time()-start_t}s"
+            )
+            return res
+
+    def preload(self):
+        """
+        load the model in background, no-op if loaded or loading
+        """
+        with self._batch_cond:
+            if self.model is not None or self.loading:
+                return
+            self.loading = True
+        threading.Thread(
+            target=self._preload, name="TranslatorPreload", daemon=True
+        ).start()
+
+    def _preload(self):
+        try:
+            with self._model_lock:
+                self._load_model()
+                # a preloaded model is idle from now on
+                self.last_used_at = time.time()
+        except Exception as err:
+            logging.error(f"[Translator] preload err: {err}")
+        finally:
+            self.loading = False
+
+    def _load_model(self):
+        # caller holds _model_lock
+        if self.model is not None:
+            return
+        translator_conf = ConfigMgr().get_conf("translator")
+        if translator_conf["debug"]:
+            pretrained_model_name_or_path = "models/translation/opus-mt-zh-en"
+        else:
+            raise NotImplementedError()
+        start_t = time.time()
+        rss_before = _rss_bytes()
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            pretrained_model_name_or_path=pretrained_model_name_or_path,
+            local_files_only=True,
+        )
+        model.to(translator_conf["device"])
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            pretrained_model_name_or_path=pretrained_model_name_or_path,
+            local_files_only=True,
+        )
+        self.model = model
+        self.load_seconds = time.time() - start_t
+        self.loads += 1
+        self.model_bytes = sum(
+            t.numel() * t.element_size()
+            for t in [*model.parameters(), *model.buffers()]
+        )
+        rss_after = _rss_bytes()
+        self.rss_delta_on_load = (
+            rss_after - rss_before
+            if rss_before is not None and rss_after is not None
+            else None
+        )
+        logging.info(
+            f"[Translator] model load cost {round(self.load_seconds, 2)}s, model bytes: {self.model_bytes}"
+        )
+
+    def _unload_loop(self):
+        while True:
+            time.sleep(max(1, min(UNLOAD_CHECK_SECONDS, self.unload_seconds)))
+            try:
+                self._unload_if_idle()
+            except Exception as err:
+                logging.error(f"[Translator] unload err: {err}")
+
+    def _unload_if_idle(self):
+        with self._model_lock:
+            if self.model is None:
+                return
+            with self._batch_cond:
+                # queued or being translated, it will need the model
+                if self._inflight != 0:
+                    return
+            if time.time() - self.last_used_at < self.unload_seconds:
+                return
+            self._unload_model()
+
+    def _unload_model(self):
+        # caller holds _model_lock
+        device = getattr(self.model, "device", None)
+        self.model = None
+        self.tokenizer = None
+        gc.collect()
+        self.unloads += 1
+        if str(device).startswith("cuda"):
+            torch.cuda.empty_cache()
+        logging.info(f"[Translator] model unloaded after {self.unload_seconds}s idle")
+
+    def metrics(self) -> dict:
+        with self._batch_cond:
+            pending = len(self._pending)
+            inflight = self._inflight
+        loaded = self.model is not None
+        return {
+            "loaded": loaded,
+            "loading": self.loading,
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "load_seconds": (
+                round(self.load_seconds, 3) if self.load_seconds is not None else None
+            ),
+            "model_bytes": self.model_bytes if loaded else 0,
+            "rss_delta_on_load": self.rss_delta_on_load,
+            "rss_bytes": _rss_bytes(),
+            "idle_seconds": (
+                round(time.time() - self.last_used_at, 1) if loaded else None
+            ),
+            "pending": pending,
+            "inflight": inflight,
+            "batches": self.batches,
+            "translated": self.translated,
+        }
+
+
+def _rss_bytes() -> Optional[int]:
+    """
+    resident set of the process, the model is most of it once loaded
+
+    return: None where neither /proc nor resource is available
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    # peak instead of current where /proc is missing, kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,3 +1,4 @@
+import math
 from fastapi import UploadFile
 import shutil
 from pathlib import Path
@@ -16,3 +17,13 @@ def get_value_index_in_enum(value, enum_class):
         if item.value == value:
             return index
     return None
+
+
+def percentile(sorted_values: list, p: float):
+    """
+    nearest rank, sorted_values must not be empty
+    """
+    rank = max(
+        0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1)
+    )
+    return sorted_values[rank]
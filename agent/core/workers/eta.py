@@ -0,0 +1,268 @@
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from core.config import ConfigMgr
+from core.models.gen_image.db import (
+    get_gen_image_task_last_span_seconds_db,
+    get_gen_image_task_span_tasks_db,
+)
+
+# until enough executions are seen
+DEFAULT_OVERHEAD_SECONDS = 1.0
+# one sampling step of one 1024x1024 image
+DEFAULT_SECONDS_PER_UNIT = 0.4
+# weight of an older execution shrinks by this factor per new one
+FIT_DECAY = 0.98
+FIT_MIN_SAMPLES = 3
+STAGE_EWMA_ALPHA = 0.2
+# spans of every stage read at startup, so predictions survive a restart
+DEFAULT_ETA_SEED_SPANS = 200
+
+STAGE_TRANSLATE = "translate"
+# waiting for a backend slot and posting the prompt
+STAGE_SUBMIT = "submit"
+# queued on comfyui
+STAGE_QUEUE = "comfyui_queue"
+STAGE_EXECUTE = "execute"
+# downloading the images
+STAGE_COLLECT = "download"
+STAGE_PERSIST = "persist"
+STAGES = [
+    STAGE_TRANSLATE,
+    STAGE_SUBMIT,
+    STAGE_QUEUE,
+    STAGE_EXECUTE,
+    STAGE_COLLECT,
+    STAGE_PERSIST,
+]
+DEFAULT_STAGE_SECONDS = {
+    STAGE_TRANSLATE: 0.5,
+    STAGE_SUBMIT: 0.1,
+    STAGE_QUEUE: 0.0,
+    STAGE_COLLECT: 1.0,
+    STAGE_PERSIST: 0.1,
+}
+
+
+def work_units(steps: int, batch_size: int, width: int, height: int) -> float:
+    return (
+        (steps or 1)
+        * (batch_size or 1)
+        * (width or 1024)
+        * (height or 1024)
+        / (1024 * 1024)
+    )
+
+
+def task_units(task) -> float:
+    return work_units(
+        getattr(task, "steps", None),
+        getattr(task, "batch_size", None),
+        getattr(task, "width", None),
+        getattr(task, "height", None),
+    )
+
+
+class LinearFit:
+    """
+    seconds = overhead + seconds_per_unit * units, least squares over
+    exponentially decayed samples so the fit follows hardware changes
+    """
+
+    def __init__(self) -> None:
+        self.n = 0.0
+        self.sx = 0.0
+        self.sy = 0.0
+        self.sxx = 0.0
+        self.sxy = 0.0
+        self.samples = 0
+
+    def add(self, x: float, y: float):
+        self.n = self.n * FIT_DECAY + 1
+        self.sx = self.sx * FIT_DECAY + x
+        self.sy = self.sy * FIT_DECAY + y
+        self.sxx = self.sxx * FIT_DECAY + x * x
+        self.sxy = self.sxy * FIT_DECAY + x * y
+        self.samples += 1
+
+    def coefficients(self) -> Optional[Tuple[float, float]]:
+        if self.samples < FIT_MIN_SAMPLES or self.sx <= 0:
+            return None
+        var = self.n * self.sxx - self.sx * self.sx
+        if var > 1e-9:
+            b = (self.n * self.sxy - self.sx * self.sy) / var
+            a = (self.sy - b * self.sx) / self.n
+            if b > 0 and a >= 0:
+                return a, b
+        # one size seen only, or noise: plain ratio
+        return 0.0, self.sy / self.sx
+
+    def predict(self, x: float) -> Optional[float]:
+        coefficients = self.coefficients()
+        if coefficients is None:
+            return None
+        a, b = coefficients
+        return a + b * x
+
+
+class EtaModel:
+    """
+    execution seconds of txt2img prompts fitted per ckpt and sampler from
+    timed executions, and average seconds of the other stages of a task
+
+    feeds fair queueing costs, admission backlog, queue waits and the
+    predicted finish time of tasks
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    instance = super().__new__(cls)
+                    instance._init_instance()
+                    cls._instance = instance
+        return cls._instance
+
+    def _init_instance(self):
+        self._mutex = threading.Lock()
+        # ("ckpt_sampler", ckpt, sampler) / ("ckpt", ckpt) / ("all",)
+        self._fits: Dict[tuple, LinearFit] = {}
+        self._stage_seconds = dict(DEFAULT_STAGE_SECONDS)
+        self._stage_samples = {stage: 0 for stage in STAGES}
+        # |predicted - seen| / seen of executions
+        self.error_ratio = None
+        self.seeded = 0
+        seed_spans = (
+            ConfigMgr().get_conf("worker").get("eta_seed_spans", DEFAULT_ETA_SEED_SPANS)
+        )
+        if seed_spans > 0:
+            self._seed(seed_spans)
+
+    def _seed(self, limit: int):
+        try:
+            execute_spans = get_gen_image_task_span_tasks_db(STAGE_EXECUTE, limit)
+            stage_spans = {
+                stage: get_gen_image_task_last_span_seconds_db(stage, limit)
+                for stage in STAGES
+                if stage != STAGE_EXECUTE
+            }
+        except Exception as err:
+            logging.warning(f"eta seed from spans err: {err}")
+            return
+        # coalesced tasks got the execute span of their shared prompt
+        prompts: Dict[str, list] = {}
+        for prompt_id, seconds, ckpt_name, sampler_name, *size in execute_spans:
+            prompt = prompts.setdefault(prompt_id, [ckpt_name, sampler_name, 0.0, 0.0])
+            prompt[2] += work_units(*size)
+            prompt[3] = seconds
+        with self._mutex:
+            for ckpt_name, sampler_name, units, seconds in prompts.values():
+                self._add_execute(ckpt_name, sampler_name, units, seconds)
+            for stage, seconds_list in stage_spans.items():
+                for seconds in seconds_list:
+                    self._observe_stage(stage, seconds)
+            self.seeded = len(prompts)
+        logging.info(f"eta seeded from {len(prompts)} executions")
+
+    @staticmethod
+    def _keys(ckpt_name: str, sampler_name: str) -> list:
+        return [
+            ("ckpt_sampler", ckpt_name or "", sampler_name or ""),
+            ("ckpt", ckpt_name or ""),
+            ("all",),
+        ]
+
+    def predict_execute(self, ckpt_name: str, sampler_name: str, units: float) -> float:
+        with self._mutex:
+            return self._predict_execute(ckpt_name, sampler_name, units)
+
+    def _predict_execute(self, ckpt_name: str, sampler_name: str, units: float):
+        for key in self._keys(ckpt_name, sampler_name):
+            fit = self._fits.get(key)
+            seconds = fit.predict(units) if fit else None
+            if seconds is not None:
+                return seconds
+        return DEFAULT_OVERHEAD_SECONDS + DEFAULT_SECONDS_PER_UNIT * units
+
+    def predict_task(self, task) -> float:
+        """
+        execution seconds of a GenImageWorkerTask run alone
+        """
+        return self.predict_execute(
+            getattr(task, "ckpt_name", None),
+            getattr(task, "sampler_name", None),
+            task_units(task),
+        )
+
+    def observe_execute(
+        self, ckpt_name: str, sampler_name: str, units: float, seconds: float
+    ):
+        with self._mutex:
+            predicted = self._predict_execute(ckpt_name, sampler_name, units)
+            if seconds > 0:
+                error_ratio = abs(predicted - seconds) / seconds
+                self.error_ratio = (
+                    error_ratio
+                    if self.error_ratio is None
+                    else self.error_ratio
+                    + STAGE_EWMA_ALPHA * (error_ratio - self.error_ratio)
+                )
+            self._add_execute(ckpt_name, sampler_name, units, seconds)
+
+    def _add_execute(
+        self, ckpt_name: str, sampler_name: str, units: float, seconds: float
+    ):
+        for key in self._keys(ckpt_name, sampler_name):
+            self._fits.setdefault(key, LinearFit()).add(units, seconds)
+        self._observe_stage(STAGE_EXECUTE, seconds)
+
+    def observe_stage(self, stage: str, seconds: float):
+        with self._mutex:
+            self._observe_stage(stage, seconds)
+
+    def _observe_stage(self, stage: str, seconds: float):
+        if self._stage_samples[stage] == 0:
+            self._stage_seconds[stage] = seconds
+        else:
+            self._stage_seconds[stage] += STAGE_EWMA_ALPHA * (
+                seconds - self._stage_seconds[stage]
+            )
+        self._stage_samples[stage] += 1
+
+    def stage_seconds(self, *stages: str) -> float:
+        """
+        average seconds of stages other than execute, added up
+        """
+        with self._mutex:
+            return sum(self._stage_seconds.get(stage, 0.0) for stage in stages)
+
+    def metrics(self) -> dict:
+        with self._mutex:
+            fits = {}
+            for key, fit in self._fits.items():
+                coefficients = fit.coefficients()
+                fits["/".join(key)] = {
+                    "samples": fit.samples,
+                    "overhead_seconds": (
+                        round(coefficients[0], 3) if coefficients else None
+                    ),
+                    "seconds_per_unit": (
+                        round(coefficients[1], 4) if coefficients else None
+                    ),
+                }
+            return {
+                "fits": fits,
+                "stage_seconds": {
+                    stage: round(seconds, 3)
+                    for stage, seconds in self._stage_seconds.items()
+                },
+                "stage_samples": dict(self._stage_samples),
+                "seeded": self.seeded,
+                "execute_error_ratio": (
+                    round(self.error_ratio, 3) if self.error_ratio is not None else None
+                ),
+            }
@@ -1,7 +1,9 @@
 import threading
 from queue import Queue
 import logging
-from typing import Dict, List, Union, Any, Optional
+import math
+import time
+from typing import Dict, List, Tuple, Union, Any, Optional
 from pydantic import BaseModel
 import uuid
 import os
@@ -10,8 +12,13 @@ import traceback
 
 from core.config import ConfigMgr
 from core.comfyui.comfyui_client import ComfyUIClient
+from core.comfyui.backend_pool import BackendPool
 from core.comfyui.workflows import basic_txt2img
-from core.comfyui.workflows.basic_txt2img import BasicTxt2imgTask
+from core.comfyui.workflows.basic_txt2img import (
+    BasicTxt2imgBatch,
+    BasicTxt2imgTask,
+    BasicTxt2imgTaskResult,
+)
 from core.const import *
 from core.models.common import WSEvent
 from core.models.gen_image.object import *
@@ -24,6 +31,52 @@ from core.comfyui.comfyui_client import *
 from core.utils.translator import Translator
 from core.utils.unionenum import enum_union
 from core.utils.utils import get_value_index_in_enum
+from core.workers import eta
+from core.workers.eta import EtaModel
+from core.workers.pipeline import PipelineStage
+from core.workers.task_queue import (
+    DEFAULT_PRIORITY,
+    PRIORITIES,
+    PRIORITY_BACKGROUND,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    GenImageTaskQueue,
+)
+
+DEFAULT_WORKER_CONCURRENCY = 2
+# batches in the pipeline of a worker: translating the next one, running the
+# current one on comfyui and persisting the last one
+DEFAULT_MAX_INFLIGHT_BATCHES = 3
+DEFAULT_TRANSLATE_CONCURRENCY = 1
+DEFAULT_SUBMIT_CONCURRENCY = 1
+DEFAULT_PERSIST_CONCURRENCY = 1
+# an interactive task queued this long stops a running task of lower
+# priority, 0 to disable
+DEFAULT_PREEMPT_AFTER_SECONDS = 30
+# a task is not stopped more often than this
+DEFAULT_MAX_PREEMPTIONS = 1
+PREEMPT_CHECK_SECONDS = 1
+# admission limits per priority class, 0 is unlimited
+DEFAULT_ADMISSION = {
+    PRIORITY_INTERACTIVE: {"max_queued": 100, "max_backlog_seconds": 600},
+    PRIORITY_BATCH: {"max_queued": 500, "max_backlog_seconds": 3600},
+    PRIORITY_BACKGROUND: {"max_queued": 2000, "max_backlog_seconds": 21600},
+}
+DEFAULT_COALESCE_WINDOW_MS = 20
+DEFAULT_COALESCE_MAX_TASKS = 4
+DEFAULT_COALESCE_MAX_BATCH_SIZE = 8
+
+# spans of a task besides eta.STAGES, stored by add_gen_image_task_spans_db
+SPAN_QUEUE_WAIT = "queue_wait"
+# followed by the class_type of the node
+SPAN_NODE_PREFIX = "node:"
+SPAN_DB_COMMIT = "db_commit"
+
+# results of cancel_task
+CANCEL_NOT_FOUND = "not_found"
+CANCEL_DONE = "done"
+# canceled here, but the prompt may still run on comfyui
+CANCEL_STOP_FAILED = "stop_failed"
 
 
 class GenImageWorkerProgressNameBefore(Enum):
@@ -43,184 +96,640 @@ GenImageWorkerProgressName = enum_union(
 )
 
 
+class GenImageJob:
+    """
+    coalesced tasks passed through the stages of GenImageWorker
+    """
+
+    def __init__(self, new_tasks: List[GenImageWorkerTask]) -> None:
+        self.new_tasks = new_tasks
+        self.gen_image_tasks: Dict[int, GenImageTask] = {}
+        self.basic_txt2img_tasks: List[BasicTxt2imgTask] = []
+        self.batch: BasicTxt2imgBatch = None
+        self.results: List[BasicTxt2imgTaskResult] = []
+        # done, failed or canceled already
+        self.finished_task_ids = set()
+        self.submitted_at = None
+        self.preempting = False
+        # its inflight slot is given back, see GenImageWorker._job_done
+        self.released = False
+        # holds a BackendPool reservation until it is submitted
+        self.slot_reserved = True
+        # stage -> seconds, see eta.STAGES
+        self.stage_seconds: Dict[str, float] = {}
+        # (name, seconds) shared by the tasks, and of one task
+        self.spans: List[Tuple[str, float]] = []
+        self.task_spans: Dict[int, List[Tuple[str, float]]] = {
+            task.task_id: [] for task in new_tasks
+        }
+        # coalesced tasks share ckpt and sampler
+        self.predicted_execute_seconds = EtaModel().predict_execute(
+            new_tasks[0].ckpt_name,
+            new_tasks[0].sampler_name,
+            sum(eta.task_units(task) for task in new_tasks),
+        )
+
+    def priority_rank(self) -> int:
+        # a batch is as urgent as its most urgent task
+        return min(
+            PRIORITIES.index(task.priority or DEFAULT_PRIORITY)
+            for task in self.new_tasks
+        )
+
+    def add_span(self, name: str, seconds: float, task_id: int = None):
+        if task_id is None:
+            self.spans.append((name, seconds))
+        else:
+            self.task_spans[task_id].append((name, seconds))
+
+    def record_stage(self, stage: str, seconds: float):
+        self.stage_seconds[stage] = seconds
+        self.add_span(stage, seconds)
+        EtaModel().observe_stage(stage, seconds)
+
+    def predicted_finish_at(self) -> float:
+        """
+        the stages left take their average seconds, the execution its
+        predicted seconds from when comfyui started it
+        """
+        model = EtaModel()
+        now = time.time()
+        if self.results:
+            return now + model.stage_seconds(eta.STAGE_PERSIST)
+        state = self.batch.prompt_state if self.batch else None
+        after_execute = model.stage_seconds(eta.STAGE_COLLECT, eta.STAGE_PERSIST)
+        if state and state.executed_at:
+            return now + after_execute
+        if state and state.started_at:
+            return (
+                max(now, state.started_at + self.predicted_execute_seconds)
+                + after_execute
+            )
+        return (
+            now
+            + model.stage_seconds(*self._stages_before_execute())
+            + self.predicted_execute_seconds
+            + after_execute
+        )
+
+    def queue_wait_seconds(self) -> float:
+        """
+        average seconds of the stages left until comfyui starts the execution
+        """
+        state = self.batch.prompt_state if self.batch else None
+        if self.results or (state and state.started_at):
+            return 0.0
+        return EtaModel().stage_seconds(*self._stages_before_execute())
+
+    def _stages_before_execute(self) -> List[str]:
+        stages = [eta.STAGE_QUEUE]
+        if not self.submitted_at:
+            stages.append(eta.STAGE_SUBMIT)
+        if eta.STAGE_TRANSLATE not in self.stage_seconds:
+            stages.append(eta.STAGE_TRANSLATE)
+        return stages
+
+
 class GenImageWorker(threading.Thread):
+    """
+    takes tasks from the queue and runs them through the stages
+    translate -> submit -> collect -> persist, so the next task is
+    translated while comfyui runs the current one and the last one is
+    written to db meanwhile
+    """
 
-    def __init__(self):
-        threading.Thread.__init__(self, name="GenImageWorker")
-        self.task_queue = Queue()
+    def __init__(self, task_queue: GenImageTaskQueue = None, index: int = 0):
+        threading.Thread.__init__(self, name=f"GenImageWorker-{index}")
+        self.task_queue = task_queue if task_queue else GenImageTaskQueue()
+        # task scoped state, one client per worker
         self.comfyui_client = ComfyUIClient()
-        self.progress_value = 0
+
+        # compatible txt2img tasks are run as one comfyui prompt
+        worker_conf = ConfigMgr().get_conf("worker")
+        self.coalesce_window = (
+            worker_conf.get("coalesce_window_ms", DEFAULT_COALESCE_WINDOW_MS) / 1000
+        )
+        self.coalesce_max_tasks = worker_conf.get(
+            "coalesce_max_tasks", DEFAULT_COALESCE_MAX_TASKS
+        )
+        self.coalesce_max_batch_size = worker_conf.get(
+            "coalesce_max_batch_size", DEFAULT_COALESCE_MAX_BATCH_SIZE
+        )
+
+        # batches taken from the queue and not finished yet
+        max_inflight = worker_conf.get(
+            "max_inflight_batches", DEFAULT_MAX_INFLIGHT_BATCHES
+        )
+        self._inflight = threading.Semaphore(max_inflight)
+        self.translate_stage = PipelineStage(
+            "translate",
+            self._translate,
+            worker_conf.get("translate_concurrency", DEFAULT_TRANSLATE_CONCURRENCY),
+            self._job_failed,
+        )
+        self.submit_stage = PipelineStage(
+            "submit",
+            self._submit,
+            worker_conf.get("submit_concurrency", DEFAULT_SUBMIT_CONCURRENCY),
+            self._job_failed,
+        )
+        # one waiter for every batch which may be in flight
+        self.collect_stage = PipelineStage(
+            "collect",
+            self._collect,
+            worker_conf.get("collect_concurrency", max_inflight),
+            self._job_failed,
+        )
+        self.persist_stage = PipelineStage(
+            "persist",
+            self._persist,
+            worker_conf.get("persist_concurrency", DEFAULT_PERSIST_CONCURRENCY),
+            self._job_failed,
+        )
+        self.stages = [
+            self.translate_stage,
+            self.submit_stage,
+            self.collect_stage,
+            self.persist_stage,
+        ]
+
+        self._tasks_lock = threading.Lock()
+        self.jobs: List[GenImageJob] = []
+        self.cur_task_ids = set()
+        # running tasks canceled while sharing a prompt with other tasks
+        self.canceled_task_ids = set()
 
     def run(self):
-        logging.info(f"GenImageWorker run start")
+        logging.info(f"{self.name} run start")
+        for stage in self.stages:
+            stage.start(self.name)
         while True:
+            self._inflight.acquire()
+            # tasks wait in the fair queue, not in front of a full backend
+            BackendPool().reserve()
+            new_tasks = []
+            handed_off = False
             try:
                 new_task: GenImageWorkerTask = self.task_queue.get()
+                new_tasks = [new_task, *self._coalesce(new_task)]
+                with self._tasks_lock:
+                    self.cur_task_ids.update(task.task_id for task in new_tasks)
                 logging.info(
-                    f"GenImageWorker start handle new task: {new_task.task_id}"
-                )
-                gen_image_task = get_gen_image_task_db(new_task.task_id)
-                EventDispatcher().dispatch_event(
-                    EVENT_TYPE_WS,
-                    WSEvent(
-                        topic=TOPIC_GENIMAGE_PROGRESS,
-                        data=GenImageEvent.Data(
-                            task_id=new_task.task_id,
-                            progress_name=TOPIC_GENIMAGE_PROGRESS,
-                            progress_tip=GenImageWorkerProgressNameBefore.START.value,
-                            progress_value=list(GenImageWorkerProgressName).index(
-                                GenImageWorkerProgressNameBefore.START
-                            ),
-                            progress_value_max=len(GenImageWorkerProgressName),
-                        ),
-                    ),
-                )
-                EventDispatcher().add_event_listener(
-                    event_type=f"{EVENT_TYPE_INTERNAL_COMFYUI}_{new_task.task_id}",
-                    listener=self.update_progress_listener,
+                    f"{self.name} start handle new task: {[task.task_id for task in new_tasks]}"
                 )
 
                 match new_task.task_type:
                     case TaskType.TXT2IMG:
-                        prompt = gen_image_task.origin_prompt
-                        if (
-                            Translator.detect_language(gen_image_task.origin_prompt)
-                            == "zh-cn"
-                        ):
-                            EventDispatcher().dispatch_event(
-                                EVENT_TYPE_WS,
-                                WSEvent(
-                                    topic=TOPIC_GENIMAGE_PROGRESS,
-                                    data=GenImageEvent.Data(
-                                        task_id=new_task.task_id,
-                                        progress_name=TOPIC_GENIMAGE_PROGRESS,
-                                        progress_tip=GenImageWorkerProgressNameBefore.TRANSLATION_START.value,
-                                        progress_value=list(
-                                            GenImageWorkerProgressName
-                                        ).index(
-                                            GenImageWorkerProgressNameBefore.TRANSLATION_START
-                                        ),
-                                        progress_value_max=len(
-                                            GenImageWorkerProgressName
-                                        ),
-                                    ),
-                                ),
-                            )
-                            prompt = Translator().run(gen_image_task.origin_prompt)
-                            EventDispatcher().dispatch_event(
-                                EVENT_TYPE_WS,
-                                WSEvent(
-                                    topic=TOPIC_GENIMAGE_PROGRESS,
-                                    data=GenImageEvent.Data(
-                                        task_id=new_task.task_id,
-                                        progress_name=TOPIC_GENIMAGE_PROGRESS,
-                                        progress_tip=GenImageWorkerProgressNameBefore.TRANSLATION_END.value,
-                                        progress_value=list(
-                                            GenImageWorkerProgressName
-                                        ).index(
-                                            GenImageWorkerProgressNameBefore.TRANSLATION_END
-                                        ),
-                                        progress_value_max=len(
-                                            GenImageWorkerProgressName
-                                        ),
-                                    ),
-                                ),
-                            )
-                        basic_txt2img_task = BasicTxt2imgTask(
-                            task_id=new_task.task_id,
-                            prompt=prompt,
-                            ckpt_name=gen_image_task.ckpt_name,
-                            negative_prompt=gen_image_task.negative_prompt,
-                            seed=gen_image_task.seed,
-                            steps=gen_image_task.steps,
-                            cfg=gen_image_task.cfg,
-                            sampler_name=gen_image_task.sampler_name,
-                            scheduler=gen_image_task.scheduler,
-                            denoise=gen_image_task.denoise,
-                            batch_size=gen_image_task.batch_size,
-                            width=gen_image_task.width,
-                            height=gen_image_task.height,
-                        )
-                        basic_txt2img_task_result = basic_txt2img.run(
-                            self.comfyui_client, basic_txt2img_task
-                        )
-                        # task failed
-                        if basic_txt2img_task_result.err_msg != None:
-                            err_msg = f"basic_txt2img_task failed: {basic_txt2img_task_result.err_msg}"
-                            logging.error(err_msg)
-                            # update task status to db
-                            update_gen_image_task_status(
-                                task_id=gen_image_task.id,
-                                task_status=TASK_FAILED,
-                                err_msg=err_msg,
-                            )
-                            EventDispatcher().remove_event_listener(
-                                f"{EVENT_TYPE_INTERNAL_COMFYUI}_{new_task.task_id}",
-                                self.update_progress_listener,
-                            )
-                            EventDispatcher().dispatch_event(
-                                EVENT_TYPE_WS,
-                                WSEvent(
-                                    topic=TOPIC_GENIMAGE_FAILED,
-                                    data=GenImageEvent.Data(
-                                        task_id=new_task.task_id,
-                                        err_msg=err_msg,
-                                    ),
-                                ),
-                            )
-                            continue
-                        images = []
-                        image_uuid_list = []
-                        for image in basic_txt2img_task_result.images:
-                            image_uuid = str(uuid.uuid4())
-                            image_name = image_uuid + ".png"
-                            StorageMgr().save_image(filename=image_name, image=image)
-                            images.append(image_name)
-                            image_uuid_list.append(image_uuid)
-                        add_sd_images_db(
-                            uuid_list=image_uuid_list,
-                            format="png",
-                            origin_prompt=gen_image_task.origin_prompt,
-                            prompt=basic_txt2img_task_result.prompt,
-                            negative_prompt=basic_txt2img_task_result.negative_prompt,
-                            width=basic_txt2img_task_result.width,
-                            height=basic_txt2img_task_result.height,
-                            seed=basic_txt2img_task_result.seed,
-                            steps=basic_txt2img_task_result.steps,
-                            cfg=basic_txt2img_task_result.cfg,
-                            sampler_name=basic_txt2img_task_result.sampler_name,
-                            scheduler=basic_txt2img_task_result.scheduler,
-                            denoise=basic_txt2img_task_result.denoise,
-                            ckpt_name=basic_txt2img_task_result.ckpt_name,
-                            gen_image_task_id=gen_image_task.id,
-                        )
-                        update_gen_image_task_status(
-                            task_id=gen_image_task.id, task_status=TASK_DONE
-                        )
+                        job = GenImageJob(new_tasks)
+                        dispatched_at = time.time()
+                        for task in new_tasks:
+                            if task.enqueued_at:
+                                job.add_span(
+                                    SPAN_QUEUE_WAIT,
+                                    dispatched_at - task.enqueued_at,
+                                    task.task_id,
+                                )
+                        with self._tasks_lock:
+                            self.jobs.append(job)
+                        self.translate_stage.put(job)
+                        handed_off = True
                     case _:
                         logging.warning(
                             f"not support target task type: {new_task.task_type}, task id: {new_task.task_id}"
                         )
                         continue
+            except Exception as err:
+                traceback.print_exc()
+                logging.error(f"GenImageWorker loop err: {err}")
+                continue
+            finally:
+                if not handed_off:
+                    BackendPool().unreserve()
+                    self._tasks_done(new_tasks)
+
+    def _tasks_done(self, tasks: List[GenImageWorkerTask]):
+        task_ids = [task.task_id for task in tasks]
+        with self._tasks_lock:
+            self.jobs = [job for job in self.jobs if job.new_tasks is not tasks]
+            self.cur_task_ids.difference_update(task_ids)
+            self.canceled_task_ids.difference_update(task_ids)
+        self.comfyui_client.release_tasks(task_ids)
+        self._inflight.release()
+
+    def _job_done(self, job: GenImageJob):
+        # once per job, persist may fail after it released the tasks
+        with self._tasks_lock:
+            if job.released:
+                return
+            job.released = True
+        self._unreserve(job)
+        self._tasks_done(job.new_tasks)
+
+    def _unreserve(self, job: GenImageJob):
+        with self._tasks_lock:
+            if not job.slot_reserved:
+                return
+            job.slot_reserved = False
+        BackendPool().unreserve()
 
-                EventDispatcher().remove_event_listener(
-                    f"{EVENT_TYPE_INTERNAL_COMFYUI}_{new_task.task_id}",
-                    self.update_progress_listener,
+    def _coalesce(self, new_task: GenImageWorkerTask) -> List[GenImageWorkerTask]:
+        """
+        take queued tasks which can share the latent batch of new_task,
+        waiting coalesce_window for more to arrive
+
+        only tasks of the same priority class, a batch runs as long as all
+        of its images take and is preempted as a whole
+        """
+        if (
+            new_task.task_type != TaskType.TXT2IMG
+            or new_task.seed
+            or self.coalesce_max_tasks <= 1
+            or self.coalesce_window <= 0
+        ):
+            return []
+        key = (
+            basic_txt2img.coalesce_key(new_task),
+            new_task.origin_prompt,
+            new_task.negative_prompt,
+            new_task.priority or DEFAULT_PRIORITY,
+        )
+        batch_size = [new_task.batch_size or 0]
+
+        def match(task: GenImageWorkerTask) -> bool:
+            if (
+                task.task_type != TaskType.TXT2IMG
+                or task.seed
+                or (
+                    basic_txt2img.coalesce_key(task),
+                    task.origin_prompt,
+                    task.negative_prompt,
+                    task.priority or DEFAULT_PRIORITY,
                 )
-                EventDispatcher().dispatch_event(
-                    EVENT_TYPE_WS,
-                    WSEvent(
-                        topic=TOPIC_GENIMAGE_END,
-                        data=GenImageEvent.Data(
-                            task_id=new_task.task_id, images=images
-                        ),
+                != key
+                or batch_size[0] + (task.batch_size or 0) > self.coalesce_max_batch_size
+            ):
+                return False
+            batch_size[0] += task.batch_size or 0
+            return True
+
+        return self.task_queue.take_matching(
+            match, self.coalesce_max_tasks - 1, self.coalesce_window
+        )
+
+    def job_of(self, task_id: int) -> Optional[GenImageJob]:
+        with self._tasks_lock:
+            for job in self.jobs:
+                if any(task.task_id == task_id for task in job.new_tasks):
+                    return job
+        return None
+
+    def _predicted_finish_at(self, task_id: int) -> Optional[float]:
+        job = self.job_of(task_id)
+        return round(job.predicted_finish_at(), 1) if job else None
+
+    def _queue_wait_seconds(self, task_id: int) -> Optional[float]:
+        job = self.job_of(task_id)
+        return round(job.queue_wait_seconds(), 1) if job else None
+
+    def _dispatch_progress(self, task_id: int, progress_name: Enum):
+        EventDispatcher().dispatch_event(
+            EVENT_TYPE_WS,
+            WSEvent(
+                topic=TOPIC_GENIMAGE_PROGRESS,
+                data=GenImageEvent.Data(
+                    task_id=task_id,
+                    progress_name=TOPIC_GENIMAGE_PROGRESS,
+                    progress_tip=progress_name.value,
+                    progress_value=list(GenImageWorkerProgressName).index(
+                        progress_name
                     ),
+                    progress_value_max=len(GenImageWorkerProgressName),
+                    predicted_finish_at=self._predicted_finish_at(task_id),
+                    queue_wait_seconds=self._queue_wait_seconds(task_id),
+                ),
+            ),
+        )
+
+    def _translate(self, job: GenImageJob):
+        start_at = time.time()
+        zh_task_ids = []
+        for new_task in job.new_tasks:
+            gen_image_task = get_gen_image_task_db(new_task.task_id)
+            if gen_image_task.task_status == TASK_PENDING:
+                # preempted before, running again
+                update_gen_image_task_status(new_task.task_id, TASK_DOING)
+            job.gen_image_tasks[new_task.task_id] = gen_image_task
+            self._dispatch_progress(
+                new_task.task_id, GenImageWorkerProgressNameBefore.START
+            )
+            EventDispatcher().add_event_listener(
+                event_type=f"{EVENT_TYPE_INTERNAL_COMFYUI}_{new_task.task_id}",
+                listener=self.update_progress_listener,
+            )
+            if Translator.detect_language(gen_image_task.origin_prompt) == "zh-cn":
+                zh_task_ids.append(new_task.task_id)
+                self._dispatch_progress(
+                    new_task.task_id,
+                    GenImageWorkerProgressNameBefore.TRANSLATION_START,
                 )
-                logging.info(f"GenImageWorker task done, task_id: {new_task.task_id}")
-            except Exception as err:
-                traceback.print_exc()
-                logging.error(f"GenImageWorker loop err: {err}")
+
+        # one batch for the job, tasks of other workers may join it
+        prompts = {}
+        if len(zh_task_ids) != 0:
+            translated = Translator().run_batch(
+                [job.gen_image_tasks[task_id].origin_prompt for task_id in zh_task_ids]
+            )
+            prompts = dict(zip(zh_task_ids, translated))
+            for task_id in zh_task_ids:
+                self._dispatch_progress(
+                    task_id, GenImageWorkerProgressNameBefore.TRANSLATION_END
+                )
+
+        for new_task in job.new_tasks:
+            gen_image_task = job.gen_image_tasks[new_task.task_id]
+            job.basic_txt2img_tasks.append(
+                BasicTxt2imgTask(
+                    task_id=new_task.task_id,
+                    prompt=prompts.get(new_task.task_id, gen_image_task.origin_prompt),
+                    ckpt_name=gen_image_task.ckpt_name,
+                    negative_prompt=gen_image_task.negative_prompt,
+                    seed=gen_image_task.seed,
+                    steps=gen_image_task.steps,
+                    cfg=gen_image_task.cfg,
+                    sampler_name=gen_image_task.sampler_name,
+                    scheduler=gen_image_task.scheduler,
+                    denoise=gen_image_task.denoise,
+                    batch_size=gen_image_task.batch_size,
+                    width=gen_image_task.width,
+                    height=gen_image_task.height,
+                    batch_index=(
+                        gen_image_task.task_tags.get("batch_index", 0)
+                        if isinstance(gen_image_task.task_tags, dict)
+                        else 0
+                    ),
+                )
+            )
+        translate_seconds = time.time() - start_at
+        for new_task in job.new_tasks:
+            job.add_span(eta.STAGE_TRANSLATE, translate_seconds, new_task.task_id)
+        job.stage_seconds[eta.STAGE_TRANSLATE] = translate_seconds
+        EtaModel().observe_stage(eta.STAGE_TRANSLATE, translate_seconds)
+        self.submit_stage.put(job)
+
+    def _submit(self, job: GenImageJob):
+        # blocks while every comfyui backend is full
+        job.submitted_at = time.time()
+        try:
+            job.batch = basic_txt2img.submit_batch(
+                self.comfyui_client, job.basic_txt2img_tasks
+            )
+        except TaskCanceledError:
+            self._txt2img_canceled(job)
+            return
+        finally:
+            # a backend slot is held now, or none was needed
+            self._unreserve(job)
+        job.record_stage(eta.STAGE_SUBMIT, time.time() - job.submitted_at)
+        self.collect_stage.put(job)
+
+    def _collect(self, job: GenImageJob):
+        try:
+            job.results = basic_txt2img.wait_batch(self.comfyui_client, job.batch)
+        except TaskPreemptedError:
+            self._txt2img_preempted(job)
+            return
+        except TaskCanceledError:
+            self._txt2img_canceled(job)
+            return
+        self._record_prompt_timings(job)
+        self.persist_stage.put(job)
+
+    def _record_prompt_timings(self, job: GenImageJob):
+        state = job.batch.prompt_state
+        # all served from the result cache, or the execution was not seen
+        if not state or not state.started_at or not state.executed_at:
+            return
+        job.record_stage(eta.STAGE_QUEUE, state.started_at - state.queued_at)
+        job.record_stage(eta.STAGE_COLLECT, time.time() - state.executed_at)
+        ran_task_ids = {task.task_id for task in job.batch.pending_tasks}
+        if any(
+            job.batch.results[task_id].err_msg is not None for task_id in ran_task_ids
+        ):
+            return
+        execute_seconds = state.executed_at - state.started_at
+        job.stage_seconds[eta.STAGE_EXECUTE] = execute_seconds
+        job.add_span(eta.STAGE_EXECUTE, execute_seconds)
+        for class_type, seconds in state.node_seconds:
+            job.add_span(f"{SPAN_NODE_PREFIX}{class_type}", seconds)
+        EtaModel().observe_execute(
+            job.new_tasks[0].ckpt_name,
+            job.new_tasks[0].sampler_name,
+            sum(
+                eta.task_units(task)
+                for task in job.new_tasks
+                if task.task_id in ran_task_ids
+            ),
+            execute_seconds,
+        )
+        logging.debug(
+            f"{self.name} tasks {sorted(ran_task_ids)} executed in {round(execute_seconds, 2)}s, predicted {round(job.predicted_execute_seconds, 2)}s"
+        )
+
+    def _persist(self, job: GenImageJob):
+        start_at = time.time()
+        try:
+            for basic_txt2img_task_result in job.results:
+                self._persist_result(job, basic_txt2img_task_result)
+                job.finished_task_ids.add(basic_txt2img_task_result.task_id)
+            job.record_stage(eta.STAGE_PERSIST, time.time() - start_at)
+        finally:
+            self._job_done(job)
+
+    def _persist_result(
+        self, job: GenImageJob, basic_txt2img_task_result: BasicTxt2imgTaskResult
+    ):
+        task_id = basic_txt2img_task_result.task_id
+        self._remove_progress_listener(task_id)
+        with self._tasks_lock:
+            canceled = task_id in self.canceled_task_ids
+        if canceled:
+            # the prompt went on for the other tasks, drop the images
+            for image_name in basic_txt2img_task_result.image_filenames or []:
+                StorageMgr().delete_image(image_name)
+            self._task_canceled(task_id)
+            return
+        # task failed
+        if basic_txt2img_task_result.err_msg != None:
+            err_msg = f"basic_txt2img_task failed: {basic_txt2img_task_result.err_msg}"
+            logging.error(err_msg)
+            self._task_failed(task_id, err_msg)
+            return
+        start_at = time.time()
+        self._txt2img_done(job.gen_image_tasks[task_id], basic_txt2img_task_result)
+        job.add_span(SPAN_DB_COMMIT, time.time() - start_at, task_id)
+        self._save_spans(job, task_id)
+
+    def _save_spans(self, job: GenImageJob, task_id: int):
+        # timing only, the task is done already
+        state = job.batch.prompt_state if job.batch else None
+        try:
+            add_gen_image_task_spans_db(
+                task_id,
+                job.spans + job.task_spans[task_id],
+                state.prompt_id if state else None,
+            )
+        except Exception as err:
+            logging.warning(f"{self.name} save spans of task {task_id} err: {err}")
+
+    def _txt2img_preempted(self, job: GenImageJob):
+        batch = job.batch
+        pending_task_ids = {task.task_id for task in batch.pending_tasks}
+        requeue = []
+        for basic_txt2img_task in batch.pending_tasks:
+            task_id = basic_txt2img_task.task_id
+            self._remove_progress_listener(task_id)
+            with self._tasks_lock:
+                canceled = task_id in self.canceled_task_ids
+                # no longer ours, a cancel from now on finds it in the queue
+                self.cur_task_ids.discard(task_id)
+            if canceled:
+                self._task_canceled(task_id)
+                continue
+            # the seed it ran with, so the rerun gives the same images
+            update_gen_image_task_preempted(
+                task_id, basic_txt2img_task.seed, basic_txt2img_task.batch_index
+            )
+            EventDispatcher().dispatch_event(
+                EVENT_TYPE_WS,
+                WSEvent(
+                    topic=TOPIC_GENIMAGE_PREEMPTED,
+                    data=GenImageEvent.Data(task_id=task_id),
+                ),
+            )
+            logging.info(f"GenImageWorker task preempted, task_id: {task_id}")
+            for new_task in job.new_tasks:
+                if new_task.task_id == task_id:
+                    new_task.preempted += 1
+                    # seeded now, it is not coalesced into another batch
+                    new_task.seed = basic_txt2img_task.seed
+                    requeue.append(new_task)
+        # served from the result cache before the prompt was stopped
+        job.results = [
+            batch.results[task.task_id]
+            for task in batch.tasks
+            if task.task_id not in pending_task_ids
+        ]
+        try:
+            self._persist(job)
+        finally:
+            # only after the job released them, a worker may take them at once
+            for new_task in requeue:
+                self.task_queue.put(new_task)
+
+    def preemptable_jobs(self, max_preemptions: int) -> List[GenImageJob]:
+        """
+        batches of lower than interactive priority which are on comfyui
+        """
+        with self._tasks_lock:
+            return [
+                job
+                for job in self.jobs
+                if job.batch
+                and job.batch.prompt_state
+                and not job.results
+                and not job.preempting
+                and job.priority_rank() > PRIORITIES.index(PRIORITY_INTERACTIVE)
+                and all(task.preempted < max_preemptions for task in job.new_tasks)
+            ]
+
+    def preempt_job(self, job: GenImageJob) -> bool:
+        job.preempting = True
+        return self.comfyui_client.preempt(job.batch.prompt_state)
+
+    def _txt2img_canceled(self, job: GenImageJob):
+        for new_task in job.new_tasks:
+            logging.info(f"GenImageWorker task canceled, task_id: {new_task.task_id}")
+            self._remove_progress_listener(new_task.task_id)
+            self._task_canceled(new_task.task_id)
+        self._job_done(job)
+
+    def _job_failed(self, job: GenImageJob, err: Exception):
+        if job.batch and job.batch.prompt_state and not job.results:
+            # submitted, free the backend slot
+            self.comfyui_client.abandon_prompt(job.batch.prompt_state)
+        for new_task in job.new_tasks:
+            if new_task.task_id in job.finished_task_ids:
                 continue
+            self._remove_progress_listener(new_task.task_id)
+            self._task_failed(new_task.task_id, f"GenImageWorker err: {err}")
+        self._job_done(job)
+
+    def _txt2img_done(
+        self,
+        gen_image_task: GenImageTask,
+        basic_txt2img_task_result: BasicTxt2imgTaskResult,
+    ):
+        images = []
+        image_uuid_list = []
+        for image_name in basic_txt2img_task_result.image_filenames:
+            image_uuid = os.path.splitext(image_name)[0]
+            images.append(image_name)
+            image_uuid_list.append(image_uuid)
+        add_sd_images_db(
+            uuid_list=image_uuid_list,
+            format="png",
+            origin_prompt=gen_image_task.origin_prompt,
+            prompt=basic_txt2img_task_result.prompt,
+            negative_prompt=basic_txt2img_task_result.negative_prompt,
+            width=basic_txt2img_task_result.width,
+            height=basic_txt2img_task_result.height,
+            seed=basic_txt2img_task_result.seed,
+            steps=basic_txt2img_task_result.steps,
+            cfg=basic_txt2img_task_result.cfg,
+            sampler_name=basic_txt2img_task_result.sampler_name,
+            scheduler=basic_txt2img_task_result.scheduler,
+            denoise=basic_txt2img_task_result.denoise,
+            ckpt_name=basic_txt2img_task_result.ckpt_name,
+            gen_image_task_id=gen_image_task.id,
+        )
+        if basic_txt2img_task_result.batch_index:
+            # images taken from the middle of a shared latent batch
+            update_gen_image_task_batch_index(
+                gen_image_task.id, basic_txt2img_task_result.batch_index
+            )
+        update_gen_image_task_status(task_id=gen_image_task.id, task_status=TASK_DONE)
+        EventDispatcher().dispatch_event(
+            EVENT_TYPE_WS,
+            WSEvent(
+                topic=TOPIC_GENIMAGE_END,
+                data=GenImageEvent.Data(task_id=gen_image_task.id, images=images),
+            ),
+        )
+        logging.info(f"GenImageWorker task done, task_id: {gen_image_task.id}")
+
+    def _task_failed(self, task_id: int, err_msg: str):
+        # update task status to db
+        update_gen_image_task_status(
+            task_id=task_id,
+            task_status=TASK_FAILED,
+            err_msg=err_msg,
+        )
+        EventDispatcher().dispatch_event(
+            EVENT_TYPE_WS,
+            WSEvent(
+                topic=TOPIC_GENIMAGE_FAILED,
+                data=GenImageEvent.Data(
+                    task_id=task_id,
+                    err_msg=err_msg,
+                ),
+            ),
+        )
+
+    def _remove_progress_listener(self, task_id: int):
+        EventDispatcher().remove_event_listener(
+            f"{EVENT_TYPE_INTERNAL_COMFYUI}_{task_id}",
+            self.update_progress_listener,
+        )
 
     def update_progress_listener(self, event: ComfyUIEventData):
         logging.info(f"update_progress_listener: {event}")
@@ -242,10 +751,232 @@ class GenImageWorker(threading.Thread):
                         event.progress_name, GenImageWorkerProgressName
                     ),
                     progress_value_max=len(GenImageWorkerProgressName),
+                    predicted_finish_at=self._predicted_finish_at(event.task_id),
+                    queue_wait_seconds=self._queue_wait_seconds(event.task_id),
                 ),
             ),
         )
 
+    def cancel_running_task(self, task_id: int) -> str:
+        """
+        stop a task of this worker on comfyui, queued tasks are dropped by
+        GenImageWorkerPool.cancel_task
+
+        return: CANCEL_NOT_FOUND if the task is not running in this worker
+        """
+        with self._tasks_lock:
+            if task_id not in self.cur_task_ids:
+                return CANCEL_NOT_FOUND
+            self.canceled_task_ids.add(task_id)
+        # running task ends with TaskCanceledError in the worker thread, or
+        # its images are dropped if the prompt is shared with other tasks
+        logging.info(f"{self.name} cancel running task: {task_id}")
+        if not self.comfyui_client.cancel(task_id):
+            return CANCEL_STOP_FAILED
+        return CANCEL_DONE
+
+    @staticmethod
+    def _task_canceled(task_id: int):
+        update_gen_image_task_status(task_id=task_id, task_status=TASK_CANCELED)
+        EventDispatcher().dispatch_event(
+            EVENT_TYPE_WS,
+            WSEvent(
+                topic=TOPIC_GENIMAGE_CANCELED,
+                data=GenImageEvent.Data(task_id=task_id),
+            ),
+        )
+
+
+class GenImageWorkerPool:
+    """
+    worker.concurrency GenImageWorkers sharing one task queue, so the
+    translation, downloads and db writes of a task overlap with comfyui
+    running another one
+    """
+
+    def __init__(self):
+        self.task_queue = GenImageTaskQueue()
+        worker_conf = ConfigMgr().get_conf("worker")
+        concurrency = worker_conf.get("concurrency", DEFAULT_WORKER_CONCURRENCY)
+        self.workers = [
+            GenImageWorker(self.task_queue, index) for index in range(concurrency)
+        ]
+        self.preempt_after = worker_conf.get(
+            "preempt_after_seconds", DEFAULT_PREEMPT_AFTER_SECONDS
+        )
+        self.max_preemptions = worker_conf.get(
+            "max_preemptions", DEFAULT_MAX_PREEMPTIONS
+        )
+        # interactive tasks which got a preemption already
+        self._preempted_for = set()
+        self.preempted = 0
+
+        admission_conf = worker_conf.get("admission") or {}
+        self.admission = {
+            priority: {**limits, **(admission_conf.get(priority) or {})}
+            for priority, limits in DEFAULT_ADMISSION.items()
+        }
+        self._admission_lock = threading.Lock()
+        self.rejected = {priority: 0 for priority in PRIORITIES}
+        self.rejected_not_ready = 0
+
+    def start(self):
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        if self.preempt_after > 0:
+            threading.Thread(
+                target=self._preempt_loop, name="GenImagePreempt", daemon=True
+            ).start()
+
+    @staticmethod
+    def _parallelism() -> int:
+        # prompts of different backends run at the same time
+        return max(1, len(BackendPool().healthy_backends()))
+
+    def admit(self, new_task: GenImageWorkerTask) -> Optional[Tuple[int, str, int]]:
+        """
+        check a new task against backend health and the queue limits of its
+        priority class, before anything is written for it, backlog is the
+        predicted wait for the queued tasks it does not go before
+
+        return: None if admitted, else (err code, msg, retry after seconds)
+        """
+        priority = new_task.priority or DEFAULT_PRIORITY
+        if len(BackendPool().healthy_backends()) == 0:
+            with self._admission_lock:
+                self.rejected_not_ready += 1
+            return (
+                ERR_CODE_SERVER_NOT_READY,
+                "绘图引擎不可用",
+                BackendPool().health_check_seconds,
+            )
+        limits = self.admission[priority]
+        queued, ahead_seconds = self.task_queue.backlog(priority)
+        parallelism = self._parallelism()
+        backlog_seconds = ahead_seconds / parallelism
+        task_seconds = EtaModel().predict_task(new_task) / parallelism
+        retry_after = None
+        if limits["max_queued"] > 0 and queued >= limits["max_queued"]:
+            retry_after = (queued - limits["max_queued"] + 1) * task_seconds
+        elif (
+            limits["max_backlog_seconds"] > 0
+            and backlog_seconds + task_seconds > limits["max_backlog_seconds"]
+        ):
+            retry_after = backlog_seconds + task_seconds - limits["max_backlog_seconds"]
+        if retry_after is None:
+            return None
+        with self._admission_lock:
+            self.rejected[priority] += 1
+        return (
+            ERR_CODE_SERVER_OVERLOADED,
+            f"任务过多, queued: {queued}, backlog: {round(backlog_seconds)}s",
+            max(1, math.ceil(retry_after)),
+        )
+
+    def _preempt_loop(self):
+        while True:
+            time.sleep(PREEMPT_CHECK_SECONDS)
+            try:
+                self._check_preempt()
+            except Exception as err:
+                traceback.print_exc()
+                logging.error(f"GenImageWorkerPool preempt err: {err}")
+
+    def _check_preempt(self):
+        waiting = self.task_queue.oldest_waiting(PRIORITY_INTERACTIVE)
+        if not waiting:
+            return
+        task_id, waited_seconds = waiting
+        if waited_seconds < self.preempt_after or task_id in self._preempted_for:
+            return
+        # lowest priority first, then the latest submitted loses least work
+        candidates = [
+            (worker, job)
+            for worker in self.workers
+            for job in worker.preemptable_jobs(self.max_preemptions)
+        ]
+        if len(candidates) == 0:
+            return
+        worker, job = max(
+            candidates, key=lambda c: (c[1].priority_rank(), c[1].submitted_at or 0)
+        )
+        if not worker.preempt_job(job):
+            return
+        if len(self._preempted_for) > 1024:
+            self._preempted_for.clear()
+        self._preempted_for.add(task_id)
+        self.preempted += 1
+        logging.info(
+            f"GenImageWorkerPool preempt tasks {[task.task_id for task in job.new_tasks]} for task {task_id}, waited {round(waited_seconds, 1)}s"
+        )
+
     def add_task(self, new_task: GenImageTask):
-        logging.info(f"GenImageTaskMgr add new task")
+        logging.info(f"GenImageWorkerPool add new task")
         self.task_queue.put(new_task)
+
+    def cancel_task(self, task_id: int) -> str:
+        if self.task_queue.remove(task_id):
+            logging.info(f"GenImageWorkerPool cancel queued task: {task_id}")
+            GenImageWorker._task_canceled(task_id)
+            return CANCEL_DONE
+        for worker in self.workers:
+            result = worker.cancel_running_task(task_id)
+            if result != CANCEL_NOT_FOUND:
+                return result
+        return CANCEL_NOT_FOUND
+
+    def position(self, task_id: int) -> Optional[dict]:
+        """
+        return: queue position, expected wait and predicted finish time, None
+        if the task is neither queued nor running
+        """
+        position = self.task_queue.position(task_id)
+        if position:
+            parallelism = self._parallelism()
+            wait = position.pop("ahead_seconds") / parallelism
+            execute = position.pop("seconds")
+            # its own stages around the execution
+            stages = EtaModel().stage_seconds(*eta.DEFAULT_STAGE_SECONDS.keys())
+            position["expected_wait_seconds"] = round(wait, 1)
+            position["predicted_finish_at"] = round(
+                time.time() + wait + stages + execute, 1
+            )
+            return position
+        for worker in self.workers:
+            job = worker.job_of(task_id)
+            if job:
+                return {
+                    "position": 0,
+                    "ahead": 0,
+                    "expected_wait_seconds": 0,
+                    "predicted_finish_at": round(job.predicted_finish_at(), 1),
+                }
+        return None
+
+    def metrics(self) -> dict:
+        with_tasks = 0
+        running_tasks = 0
+        inflight_prompts = 0
+        for worker in self.workers:
+            with worker._tasks_lock:
+                if len(worker.cur_task_ids) != 0:
+                    with_tasks += 1
+                running_tasks += len(worker.cur_task_ids)
+            inflight_prompts += worker.comfyui_client.inflight_prompts()
+        stages = {}
+        for index, stage in enumerate(self.workers[0].stages if self.workers else []):
+            stages[stage.name] = PipelineStage.metrics_of(
+                [worker.stages[index] for worker in self.workers]
+            )
+        return {
+            "workers": len(self.workers),
+            "busy_workers": with_tasks,
+            "running_tasks": running_tasks,
+            "inflight_prompts": inflight_prompts,
+            "preempted": self.preempted,
+            "rejected_by_priority": dict(self.rejected),
+            "rejected_not_ready": self.rejected_not_ready,
+            "stages": stages,
+            "eta": EtaModel().metrics(),
+        }
@@ -0,0 +1,116 @@
+import threading
+import logging
+import time
+import traceback
+from queue import Queue
+from typing import Callable, List
+
+
+class PipelineStage:
+    """
+    one stage of the worker pipeline, a queue served by concurrency threads
+    running handler on every item, the handler passes the item on to the
+    next stage itself
+
+    on_error(item, err) is called when handler raises, the item is dropped
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable,
+        concurrency: int = 1,
+        on_error: Callable = None,
+    ) -> None:
+        self.name = name
+        self.handler = handler
+        self.on_error = on_error
+        self.concurrency = max(1, concurrency)
+        # (put_at, item)
+        self._queue: Queue = Queue()
+        self._mutex = threading.Lock()
+
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_seconds_total = 0.0
+        self.latency_seconds_total = 0.0
+        self.latency_seconds_max = 0.0
+
+    def start(self, thread_name_prefix: str):
+        for index in range(self.concurrency):
+            threading.Thread(
+                target=self._loop,
+                name=f"{thread_name_prefix}-{self.name}-{index}",
+                daemon=True,
+            ).start()
+
+    def put(self, item):
+        self._queue.put((time.time(), item))
+
+    def _loop(self):
+        while True:
+            put_at, item = self._queue.get()
+            start_at = time.time()
+            with self._mutex:
+                self.busy += 1
+                self.wait_seconds_total += start_at - put_at
+            failed = False
+            try:
+                self.handler(item)
+            except Exception as err:
+                failed = True
+                traceback.print_exc()
+                logging.error(f"pipeline stage {self.name} err: {err}")
+                self._handle_error(item, err)
+            finally:
+                latency = time.time() - start_at
+                with self._mutex:
+                    self.busy -= 1
+                    self.processed += 1
+                    if failed:
+                        self.failed += 1
+                    self.latency_seconds_total += latency
+                    self.latency_seconds_max = max(self.latency_seconds_max, latency)
+
+    def _handle_error(self, item, err: Exception):
+        if not self.on_error:
+            return
+        try:
+            self.on_error(item, err)
+        except Exception as on_error_err:
+            traceback.print_exc()
+            logging.error(f"pipeline stage {self.name} on_error err: {on_error_err}")
+
+    def metrics(self) -> dict:
+        return PipelineStage.metrics_of([self])
+
+    @staticmethod
+    def metrics_of(stages: List["PipelineStage"]) -> dict:
+        """
+        metrics of the same stage of several workers added up
+        """
+        queue_depth = busy = concurrency = processed = failed = 0
+        wait_total = latency_total = latency_max = 0.0
+        for stage in stages:
+            with stage._mutex:
+                queue_depth += stage._queue.qsize()
+                busy += stage.busy
+                concurrency += stage.concurrency
+                processed += stage.processed
+                failed += stage.failed
+                wait_total += stage.wait_seconds_total
+                latency_total += stage.latency_seconds_total
+                latency_max = max(latency_max, stage.latency_seconds_max)
+        return {
+            "queue_depth": queue_depth,
+            "busy": busy,
+            "concurrency": concurrency,
+            "processed": processed,
+            "failed": failed,
+            "wait_seconds_avg": round(wait_total / processed, 3) if processed else 0,
+            "latency_seconds_avg": (
+                round(latency_total / processed, 3) if processed else 0
+            ),
+            "latency_seconds_max": round(latency_max, 3),
+        }
@@ -0,0 +1,328 @@
+import threading
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from core.config import ConfigMgr
+from core.workers.eta import EtaModel
+
+QUEUE_MODE_FIFO = "fifo"
+# tasks with the same ckpt_name (and size) run back to back
+QUEUE_MODE_GROUP = "group"
+
+DEFAULT_QUEUE_MODE = QUEUE_MODE_GROUP
+DEFAULT_GROUP_MAX_WAIT_SECONDS = 60
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITY_BACKGROUND = "background"
+PRIORITIES = [PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_BACKGROUND]
+
+DEFAULT_PRIORITY = PRIORITY_INTERACTIVE
+# share of the workers a priority class gets while others are queued too
+DEFAULT_PRIORITY_WEIGHTS = {
+    PRIORITY_INTERACTIVE: 100,
+    PRIORITY_BATCH: 10,
+    PRIORITY_BACKGROUND: 1,
+}
+# finish tags of idle flows are dropped beyond this many flows
+FLOW_FINISH_MAX_LEN = 1024
+
+
+def resolve_priority(priority: Optional[str], task_tags: Optional[dict]) -> str:
+    """
+    request field first, then task_tags["priority"], empty means the
+    configured default
+    """
+    if not priority and task_tags:
+        priority = task_tags.get("priority")
+    if not priority:
+        priority = (
+            ConfigMgr().get_conf("worker").get("default_priority", DEFAULT_PRIORITY)
+        )
+    return priority
+
+
+class QueuedTask:
+    def __init__(self, task) -> None:
+        self.task = task
+        self.enqueued_at = time.time()
+        # predicted execution seconds, the fair queueing cost
+        self.cost = EtaModel().predict_task(task)
+        # set by put, weighted fair queueing virtual finish time
+        self.seq = 0
+        self.finish = 0.0
+
+    @property
+    def ckpt_name(self) -> str:
+        return getattr(self.task, "ckpt_name", None) or ""
+
+    @property
+    def group_key(self) -> Tuple[str, int, int]:
+        return (
+            self.ckpt_name,
+            getattr(self.task, "width", None) or 0,
+            getattr(self.task, "height", None) or 0,
+        )
+
+    @property
+    def priority(self) -> str:
+        return getattr(self.task, "priority", None) or DEFAULT_PRIORITY
+
+    @property
+    def flow(self) -> Tuple[str, str]:
+        # tasks of one submitter in one priority class share their bandwidth
+        return (self.priority, getattr(self.task, "submitter", None) or "")
+
+    def order(self) -> Tuple[float, int]:
+        return (self.finish, self.seq)
+
+
+class GenImageTaskQueue:
+    """
+    blocking task queue with weighted fair queueing, every (priority,
+    submitter) flow gets the workers in proportion to the weight of its
+    priority class, costs are predicted execution seconds so a flow of large
+    batches does not hold up flows of small ones
+
+    in group mode pending tasks of the checkpoint (then size) loaded by the
+    last task are taken first among tasks of the same priority class, so
+    comfyui does not reload models between tasks. The task due by fair
+    queueing is always taken once it waited group_max_wait_seconds
+    """
+
+    def __init__(self) -> None:
+        worker_conf = ConfigMgr().get_conf("worker")
+        self.mode = worker_conf.get("queue_mode", DEFAULT_QUEUE_MODE)
+        self.max_wait = worker_conf.get(
+            "group_max_wait_seconds", DEFAULT_GROUP_MAX_WAIT_SECONDS
+        )
+        self.weights = {
+            **DEFAULT_PRIORITY_WEIGHTS,
+            **(worker_conf.get("priority_weights") or {}),
+        }
+        self._cond = threading.Condition(threading.Lock())
+        # arrival order
+        self._pending: List[QueuedTask] = []
+        self._last_group_key = None
+        self._seq = 0
+        self._virtual_time = 0.0
+        # flow -> finish time of its last queued task
+        self._flow_finish: Dict[Tuple[str, str], float] = {}
+
+        self.dispatched = 0
+        self.dispatched_by_priority = {priority: 0 for priority in PRIORITIES}
+        self.ckpt_switches = 0
+        self.ckpt_switches_avoided = 0
+        self.reordered = 0
+        self.starvation_guarded = 0
+        self.coalesced = 0
+
+    def put(self, task):
+        with self._cond:
+            queued = QueuedTask(task)
+            task.enqueued_at = queued.enqueued_at
+            self._seq += 1
+            queued.seq = self._seq
+            start = max(self._virtual_time, self._flow_finish.get(queued.flow, 0.0))
+            queued.finish = start + queued.cost / self.weights.get(queued.priority, 1)
+            self._flow_finish[queued.flow] = queued.finish
+            self._pending.append(queued)
+            # several workers may wait in get or take_matching
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while len(self._pending) == 0:
+                self._cond.wait()
+            head = self._head()
+            head_queued = self._pending[head]
+            queued = self._pending.pop(self._pick(head))
+            self._dispatched(queued, head_queued)
+            return queued.task
+
+    def take_matching(self, match, max_count: int, timeout: float) -> List:
+        """
+        pop up to max_count pending tasks accepted by match(task), waiting
+        up to timeout seconds for more to arrive
+        """
+        taken = []
+        rejected = set()
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                i = 0
+                while i < len(self._pending) and len(taken) < max_count:
+                    queued = self._pending[i]
+                    if id(queued) not in rejected and match(queued.task):
+                        taken.append(self._pending.pop(i))
+                        continue
+                    rejected.add(id(queued))
+                    i += 1
+                remaining = deadline - time.time()
+                if len(taken) >= max_count or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self.dispatched += len(taken)
+            self.coalesced += len(taken)
+            for queued in taken:
+                self._count_priority(queued)
+        return [queued.task for queued in taken]
+
+    def remove(self, task_id: int) -> bool:
+        with self._cond:
+            for i, queued in enumerate(self._pending):
+                if queued.task.task_id == task_id:
+                    del self._pending[i]
+                    return True
+            return False
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def position(self, task_id: int) -> Optional[dict]:
+        """
+        place of a queued task in fair queueing order, group mode may still
+        take a few tasks of the loaded checkpoint first
+
+        return: None if the task is not queued, ahead_seconds and seconds
+        are predicted execution seconds of the tasks ahead and of the task
+        """
+        with self._cond:
+            target = None
+            for queued in self._pending:
+                if queued.task.task_id == task_id:
+                    target = queued
+                    break
+            if target is None:
+                return None
+            ahead = [q for q in self._pending if q.order() < target.order()]
+            return {
+                "priority": target.priority,
+                "position": len(ahead) + 1,
+                "ahead": len(ahead),
+                "ahead_seconds": sum(q.cost for q in ahead),
+                "seconds": target.cost,
+            }
+
+    def backlog(self, priority: str) -> Tuple[int, float]:
+        """
+        return: (tasks of priority queued, predicted execution seconds of
+        the queued tasks of priority or higher, which a new task of priority
+        waits for)
+        """
+        rank = PRIORITIES.index(priority)
+        with self._cond:
+            queued = 0
+            ahead_seconds = 0.0
+            for q in self._pending:
+                if q.priority == priority:
+                    queued += 1
+                if q.priority in PRIORITIES and PRIORITIES.index(q.priority) <= rank:
+                    ahead_seconds += q.cost
+            return queued, ahead_seconds
+
+    def oldest_waiting(self, priority: str) -> Optional[Tuple[int, float]]:
+        """
+        return: (task_id, seconds queued) of the longest waiting task of
+        priority, None if there is none
+        """
+        with self._cond:
+            oldest = None
+            for queued in self._pending:
+                if queued.priority != priority:
+                    continue
+                if oldest is None or queued.enqueued_at < oldest.enqueued_at:
+                    oldest = queued
+            if oldest is None:
+                return None
+            return oldest.task.task_id, time.time() - oldest.enqueued_at
+
+    def _head(self) -> int:
+        # task due by fair queueing
+        return min(range(len(self._pending)), key=lambda i: self._pending[i].order())
+
+    def _pick(self, head: int) -> int:
+        if self.mode != QUEUE_MODE_GROUP or self._last_group_key is None:
+            return head
+        priority = self._pending[head].priority
+        index = self._find(
+            lambda q: q.priority == priority and q.group_key == self._last_group_key
+        )
+        if index is None:
+            index = self._find(
+                lambda q: q.priority == priority
+                and q.ckpt_name == self._last_group_key[0]
+            )
+        if index is None or index == head:
+            return head
+        if time.time() - self._pending[head].enqueued_at >= self.max_wait:
+            self.starvation_guarded += 1
+            return head
+        return index
+
+    def _find(self, match) -> Optional[int]:
+        # first matching task in fair queueing order
+        found = None
+        for i, queued in enumerate(self._pending):
+            if match(queued) and (
+                found is None or queued.order() < self._pending[found].order()
+            ):
+                found = i
+        return found
+
+    def _dispatched(self, queued: QueuedTask, head_queued: QueuedTask):
+        self.dispatched += 1
+        self._count_priority(queued)
+        self._virtual_time = max(self._virtual_time, queued.finish)
+        if len(self._flow_finish) > FLOW_FINISH_MAX_LEN:
+            self._flow_finish = {
+                flow: finish
+                for flow, finish in self._flow_finish.items()
+                if finish > self._virtual_time
+            }
+        if queued is not head_queued:
+            self.reordered += 1
+            # fair queueing would have taken a task of another checkpoint here
+            if head_queued.ckpt_name != queued.ckpt_name:
+                self.ckpt_switches_avoided += 1
+                logging.debug(
+                    f"GenImageTaskQueue take task {queued.task.task_id} before {head_queued.task.task_id}, same ckpt: {queued.ckpt_name}"
+                )
+        if (
+            self._last_group_key is not None
+            and self._last_group_key[0] != queued.ckpt_name
+        ):
+            self.ckpt_switches += 1
+        self._last_group_key = queued.group_key
+
+    def _count_priority(self, queued: QueuedTask):
+        if queued.priority in self.dispatched_by_priority:
+            self.dispatched_by_priority[queued.priority] += 1
+
+    def metrics(self) -> dict:
+        with self._cond:
+            now = time.time()
+            pending_by_priority = {priority: 0 for priority in PRIORITIES}
+            for queued in self._pending:
+                if queued.priority in pending_by_priority:
+                    pending_by_priority[queued.priority] += 1
+            return {
+                "mode": self.mode,
+                "pending": len(self._pending),
+                "pending_by_priority": pending_by_priority,
+                "oldest_wait_seconds": (
+                    round(now - min(q.enqueued_at for q in self._pending), 1)
+                    if len(self._pending) != 0
+                    else 0
+                ),
+                "pending_seconds": round(sum(q.cost for q in self._pending), 1),
+                "dispatched": self.dispatched,
+                "dispatched_by_priority": dict(self.dispatched_by_priority),
+                "ckpt_switches": self.ckpt_switches,
+                "ckpt_switches_avoided": self.ckpt_switches_avoided,
+                "reordered": self.reordered,
+                "starvation_guarded": self.starvation_guarded,
+                "coalesced": self.coalesced,
+            }
@@ -9,7 +9,12 @@ import logging
 from core import initialize
 from core.server import server
 from core.const import *
-from core.workers.gen_image_worker import GenImageWorker
+from core.workers.gen_image_worker import GenImageWorkerPool
+from core.workers.eta import EtaModel
+from core.comfyui.object_info import ObjectInfoCatalog
+from core.comfyui.workflows.registry import WorkflowRegistry
+from core.storage.translation_cache import TranslationCache
+from core.utils.translator import Translator
 
 
 if __name__ == "__main__":
@@ -25,11 +30,22 @@ if __name__ == "__main__":
     # init api server
     srv = server.Server(loop)
 
-    # init sd gen image worker
-    gen_image_worker = GenImageWorker()
-    gen_image_worker.daemon = True
-    gen_image_worker.start()
-    srv.add_worker(WORKER_GEN_IMAGE, gen_image_worker)
+    # load comfyui object_info in background, used by params check
+    ObjectInfoCatalog()
+    # parse comfyui workflow templates once
+    WorkflowRegistry()
+    # seed the translation table from prompt examples
+    TranslationCache()
+    # starts idle unload, and loads the model in background with preload
+    Translator()
+
+    # fit execution times from the spans of earlier runs
+    EtaModel()
+
+    # init sd gen image workers
+    gen_image_worker_pool = GenImageWorkerPool()
+    gen_image_worker_pool.start()
+    srv.add_worker(WORKER_GEN_IMAGE, gen_image_worker_pool)
 
     # start api server
     try: